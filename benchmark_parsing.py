@@ -0,0 +1,50 @@
+from understat import extract_payloads
+import argparse
+import json
+import time
+
+def parse_with_beautifulsoup(content):
+    # The original parsing path of data_from_url: a full HTML parse, then unicode_escape
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content, 'html.parser')
+    script_tag = soup.find('script', string=lambda s: s and 'JSON.parse' in s)
+    raw_json_str = script_tag.string
+    start = raw_json_str.find("JSON.parse('") + len("JSON.parse('")
+    end = raw_json_str.find("')")
+    json_str = raw_json_str[start:end]
+    decoded_str = bytes(json_str, "utf-8").decode("unicode_escape")
+    return json.loads(decoded_str)
+
+def best_time(parse, content, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        parse(content)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Benchmark extracting match data from saved understat pages")
+    parser.add_argument('pages', type=str, nargs='+', help='Saved understat league pages, e.g. from curl https://understat.com/league/EPL/2023')
+    parser.add_argument('--runs', type=int, default=10, help='Number of timed runs per page')
+    args = parser.parse_args()
+
+    for path in args.pages:
+        with open(path, 'rb') as file:
+            content = file.read()
+        payloads = extract_payloads(content)
+        reference = parse_with_beautifulsoup(content)
+        # unicode_escape mangles non-ASCII names, so only the matches with ASCII team names must agree
+        ascii_matches = [i for i, match in enumerate(reference) if (match['h']['title'] + match['a']['title']).isascii()]
+        agree = all(reference[i] == payloads['datesData'][i] for i in ascii_matches)
+        beautifulsoup_time = best_time(parse_with_beautifulsoup, content, args.runs)
+        extract_time = best_time(extract_payloads, content, args.runs)
+        print(f"{path}: {len(content)/1e6:.2f} MB, payloads {', '.join(payloads)}, "
+              f"{len(payloads['datesData'])} matches ({'same as' if agree else 'DIFFERENT from'} BeautifulSoup)")
+        print(f"  BeautifulSoup + unicode_escape: {1000*beautifulsoup_time:.1f} ms")
+        print(f"  extract_payloads (all payloads): {1000*extract_time:.1f} ms, {beautifulsoup_time/extract_time:.0f}x faster")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import subprocess
+import argparse
+import time
+import sys
+
+def import_times(command):
+    # Run a command under -X importtime and collect the cumulative time of each top-level import
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        # Nested imports are indented beyond the single space that follows the separator
+        if not name[1:].startswith(' '):
+            times[name.strip()] = int(cumulative) / 1000
+    return times
+
+def wall_times(command, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Benchmark start-up time of the predict_odds CLI")
+    parser.add_argument('--runs', type=int, default=10, help='Number of timed runs')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to show')
+    parser.add_argument('command', nargs='*', default=['predict_odds.py', 'EPL', 'Arsenal', 'Chelsea', '--all'],
+                        help='Script and arguments to benchmark')
+    args = parser.parse_args()
+
+    times = wall_times(args.command, args.runs)
+    print(f"Command: python {' '.join(args.command)}")
+    print(f"Wall time over {args.runs} runs: mean {1000*sum(times)/len(times):.1f} ms, best {1000*min(times):.1f} ms")
+    baseline = wall_times(['-c', 'pass'], args.runs)
+    print(f"Bare interpreter start-up: best {1000*min(baseline):.1f} ms")
+    print("-------------------------------------------")
+
+    imports = import_times(args.command)
+    print(f"Slowest top-level imports (cumulative ms), {sum(imports.values()):.1f} ms in total")
+    for name, cumulative in sorted(imports.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{cumulative:10.1f}  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import numpy as np
+import hashlib
+import os
+
+# football-data.co.uk team names that differ from the understat names used for the fitted parameters
+TEAM_NAMES = {
+    'Man United': 'Manchester United',
+    'Man City': 'Manchester City',
+    "Nott'm Forest": 'Nottingham Forest',
+    'Wolves': 'Wolverhampton Wanderers',
+    'Newcastle': 'Newcastle United'
+}
+
+TEXT_COLUMNS = ['Div', 'Date', 'Time', 'HomeTeam', 'AwayTeam', 'FTR', 'HTR', 'Referee']
+
+# Column prefixes of every bookmaker that may appear in a football-data CSV
+BOOKMAKERS = ['B365', 'BW', 'BF', 'IW', 'PS', 'WH', 'VC', '1XB', 'BFE']
+
+# Market maximum and average columns, which are not bookmakers that can be bet with, so they are kept as
+# references and left out of the best-price search
+MARKET_AGGREGATES = ['Max', 'Avg']
+
+# Over/under columns use a shorter prefix for Pinnacle
+OVER_UNDER_PREFIXES = {'PS': 'P'}
+
+CACHE_DIR = os.path.join('data', 'betting_odds', '.cache')
+
+def normalise_team_names(names):
+    # Map every distinct name once and scatter the result back, instead of one replace per team
+    unique_names, inverse = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+    mapped = np.array([TEAM_NAMES.get(name, name) for name in unique_names])
+    return mapped[inverse]
+
+def parse_odds_csv(path):
+    import pandas as pd
+    df = pd.read_csv(path, encoding='utf-8-sig')
+    data = {}
+    for column in df.columns:
+        if column in TEXT_COLUMNS:
+            data[column] = df[column].fillna('').to_numpy(dtype=str)
+        else:
+            data[column] = pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=float)
+    return data
+
+def with_team_names(data):
+    # Applied on every load rather than cached, so changes to TEAM_NAMES take effect straight away
+    data['HomeTeam'] = normalise_team_names(data['HomeTeam'])
+    data['AwayTeam'] = normalise_team_names(data['AwayTeam'])
+    return data
+
+def cache_file_path(path, cache_dir=CACHE_DIR):
+    # One cache file per source file: the name includes a hash of the CSV's absolute path, so CSVs with
+    # the same name in different directories do not share a cache
+    source_path = os.path.abspath(path)
+    source_hash = hashlib.sha1(source_path.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir, f'{os.path.splitext(os.path.basename(path))[0]}_{source_hash}.npz')
+
+def load_odds_file(path, cache_dir=CACHE_DIR):
+    # Columns of a football-data CSV as arrays, cached as .npz and re-parsed only when the CSV changes.
+    # The cache keeps the raw team names.
+    source_mtime = os.stat(path).st_mtime_ns
+    source_path = os.path.abspath(path)
+    cache_path = cache_file_path(path, cache_dir)
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cache:
+            if int(cache['source_mtime']) == source_mtime and str(cache['source_path']) == source_path:
+                # Numeric columns are stored as the rows of one matrix, so each column is a contiguous view into it
+                data = dict(zip(cache['text_columns'].tolist(), cache['text']))
+                data.update(zip(cache['numeric_columns'].tolist(), cache['numeric']))
+                return with_team_names(data)
+
+    data = parse_odds_csv(path)
+    text_columns = [column for column in data if column in TEXT_COLUMNS]
+    numeric_columns = [column for column in data if column not in TEXT_COLUMNS]
+    os.makedirs(cache_dir, exist_ok=True)
+    temporary_path = cache_path + '.tmp.npz'
+    np.savez(temporary_path, source_mtime=np.int64(source_mtime), source_path=np.array(source_path),
+             text_columns=np.array(text_columns), text=np.stack([data[column] for column in text_columns]),
+             numeric_columns=np.array(numeric_columns), numeric=np.stack([data[column] for column in numeric_columns]))
+    os.replace(temporary_path, cache_path)
+    return with_team_names(data)
+
+def market_columns(bookmaker, market):
+    # Column names that would hold a bookmaker's odds for one market
+    ou = OVER_UNDER_PREFIXES.get(bookmaker, bookmaker)
+    columns = {
+        'result': [bookmaker+'H', bookmaker+'D', bookmaker+'A'],
+        'result_closing': [bookmaker+'CH', bookmaker+'CD', bookmaker+'CA'],
+        'over_under': [ou+'>2.5', ou+'<2.5'],
+        'over_under_closing': [ou+'C>2.5', ou+'C<2.5'],
+        'asian_handicap': [ou+'AHH', ou+'AHA'],
+        'asian_handicap_closing': [ou+'CAHH', ou+'CAHA']
+    }
+    return columns[market]
+
+def bookmaker_odds(data, market, bookmakers=None):
+    # Odds of every bookmaker quoting the market, shaped (n_matches, n_bookmakers, n_outcomes); the market
+    # aggregates are only included when asked for explicitly
+    if bookmakers is None:
+        bookmakers = BOOKMAKERS
+    available = [bookmaker for bookmaker in bookmakers
+                 if all(column in data for column in market_columns(bookmaker, market))]
+    num_matches = len(data['HomeTeam'])
+    odds = np.full((num_matches, len(available), len(market_columns('B365', market))), np.nan)
+    for i, bookmaker in enumerate(available):
+        for j, column in enumerate(market_columns(bookmaker, market)):
+            odds[:, i, j] = data[column]
+    return available, odds
+
+def handicap_lines(data, closing=False):
+    # Home handicap of the Asian handicap odds
+    return data['AHCh' if closing else 'AHh']
+
+def best_prices(odds):
+    # Highest price for each outcome across bookmakers, and the index of the bookmaker offering it
+    quoted = ~np.isnan(odds)
+    best_index = np.argmax(np.where(quoted, odds, -np.inf), axis=-2)
+    best = np.take_along_axis(odds, best_index[..., None, :], axis=-2)[..., 0, :]
+    return best, best_index
+
+def proportional_probabilities(odds):
+    implied = 1/odds
+    return implied / implied.sum(axis=-1, keepdims=True)
+
+def power_probabilities(odds, iterations=20):
+    # Find k with sum((1/odds)**k) = 1 by Newton's method, for every set of odds at once
+    implied = 1/odds
+    log_implied = np.log(implied)
+    k = np.ones(odds.shape[:-1] + (1,))
+    for _ in range(iterations):
+        powered = implied**k
+        k = k - (powered.sum(axis=-1, keepdims=True) - 1) / (powered*log_implied).sum(axis=-1, keepdims=True)
+    return implied**k
+
+def shin_probabilities(odds, iterations=50):
+    # Shin (1993): solve for the proportion of insider trading z by bisection, for every set of odds at once
+    implied = 1/odds
+    booksum = implied.sum(axis=-1, keepdims=True)
+    low = np.zeros(odds.shape[:-1] + (1,))
+    high = np.full(odds.shape[:-1] + (1,), 0.5)
+    for _ in range(iterations):
+        z = (low + high) / 2
+        probabilities = (np.sqrt(z**2 + 4*(1 - z)*implied**2/booksum) - z) / (2*(1 - z))
+        too_high = probabilities.sum(axis=-1, keepdims=True) > 1
+        low = np.where(too_high, z, low)
+        high = np.where(too_high, high, z)
+    z = (low + high) / 2
+    return (np.sqrt(z**2 + 4*(1 - z)*implied**2/booksum) - z) / (2*(1 - z))
+
+MARGIN_METHODS = {
+    'proportional': proportional_probabilities,
+    'power': power_probabilities,
+    'shin': shin_probabilities
+}
+
+def add_best_prices(data, markets=('result', 'over_under'), bookmakers=None):
+    # Add 'Best' odds columns (e.g. BestH, Best>2.5) and 'BestBookmaker' columns naming who offers them
+    for market in markets:
+        available, odds = bookmaker_odds(data, market, bookmakers)
+        if not available:
+            continue
+        best, best_index = best_prices(odds)
+        for j, (column, bookmaker_column) in enumerate(zip(market_columns('Best', market), market_columns('BestBookmaker', market))):
+            data[column] = best[:, j]
+            data[bookmaker_column] = np.array(available)[best_index[:, j]]
+    return data
+
+def remove_margin(odds, method='proportional'):
+    # Fair probabilities implied by a bookmaker's odds, with outcomes along the last axis
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return MARGIN_METHODS[method](np.asarray(odds, dtype=float))
+
+def scan_value(data, model_probabilities, market, bookmakers=None, margin_method=None, reference='PS'):
+    # Best price for every match and outcome across bookmakers, and the model's edge at that price.
+    # With margin_method, also compares the model to the reference bookmaker's fair probabilities.
+    available, odds = bookmaker_odds(data, market, bookmakers)
+    best, best_index = best_prices(odds)
+    with np.errstate(invalid='ignore'):
+        scan = {
+            'bookmakers': available,
+            'best_odds': best,
+            'best_bookmaker': np.array(available)[best_index],
+            'edge': model_probabilities * best - 1
+        }
+        if margin_method is not None:
+            # The market average stands in when the reference bookmaker does not quote the market
+            if not all(column in data for column in market_columns(reference, market)):
+                reference = 'Avg'
+            reference_odds = np.stack([np.asarray(data[column], dtype=float) for column in market_columns(reference, market)], axis=-1)
+            scan['fair_probabilities'] = remove_margin(reference_odds, margin_method)
+            scan['fair_edge'] = model_probabilities / scan['fair_probabilities'] - 1
+    return scan
@@ -0,0 +1,117 @@
+from predict_odds import load_parameters
+from predict_odds import price_fixtures
+from predict_odds import market_probabilities
+from predict_odds import result_masks
+from predict_odds import over_under_masks
+from betting_odds import load_odds_file
+from betting_odds import market_columns
+from betting_odds import remove_margin
+from test_model import outcomes_from_goals
+import pandas as pd
+import numpy as np
+import argparse
+import glob
+import os
+
+# Betting odds market: outcome names, in the order of market_columns
+OUTCOMES = {
+    'result': ['H', 'D', 'A'],
+    'over_under': ['Over2.5', 'Under2.5']
+}
+
+def load_seasons(league, data_dir='./data', bookmaker='B365', reference='PS'):
+    # Stack the columns needed for CLV from every season file of a league into one set of arrays
+    columns = ['Date', 'HomeTeam', 'AwayTeam', 'FTHG', 'FTAG']
+    for market in OUTCOMES:
+        columns += market_columns(bookmaker, market) + market_columns(reference, market+'_closing')
+    seasons = {column: [] for column in columns + ['Season']}
+    for path in sorted(glob.glob(os.path.join(data_dir, 'betting_odds', league+'_*.csv'))):
+        data = load_odds_file(path)
+        num_matches = len(data['HomeTeam'])
+        for column in columns:
+            seasons[column].append(data[column] if column in data else np.full(num_matches, np.nan))
+        seasons['Season'].append(np.full(num_matches, os.path.splitext(os.path.basename(path))[0]))
+    if not seasons['Season']:
+        raise Exception('No betting odds files found for league')
+    return {column: np.concatenate(values) for column, values in seasons.items()}
+
+def clv_ledger(data, params, bookmaker='B365', reference='PS', margin_method='proportional', edge_threshold=0, max_goals=8):
+    # Every bet the model would place at the bookmaker's opening price, with its expected value against the
+    # reference bookmaker's closing price after removing the margin, and its realised return
+    known = np.isin(data['HomeTeam'], params['teams']) & np.isin(data['AwayTeam'], params['teams'])
+    data = {column: values[known] for column, values in data.items()}
+    prob_tensor = price_fixtures(data['HomeTeam'], data['AwayTeam'], params, max_goals)
+    size = prob_tensor.shape[-1]
+    model_probabilities = {
+        'result': market_probabilities(prob_tensor, result_masks(size)),
+        'over_under': market_probabilities(prob_tensor, over_under_masks(size, 2.5))
+    }
+
+    ledgers = []
+    for market, outcomes in OUTCOMES.items():
+        opening = np.stack([data[column] for column in market_columns(bookmaker, market)], axis=1).astype(float)
+        closing = np.stack([data[column] for column in market_columns(reference, market+'_closing')], axis=1).astype(float)
+        fair_closing = remove_margin(closing, margin_method)
+        won = outcomes_from_goals(data['FTHG'], data['FTAG'], outcomes)
+
+        with np.errstate(invalid='ignore'):
+            bet = (opening * model_probabilities[market] > 1 + edge_threshold) & ~np.isnan(fair_closing).any(axis=1, keepdims=True)
+        match_index, outcome_index = np.nonzero(bet)
+        odds = opening[match_index, outcome_index]
+        ledgers.append(pd.DataFrame({
+            'Season': data['Season'][match_index],
+            'Date': data['Date'][match_index],
+            'HomeTeam': data['HomeTeam'][match_index],
+            'AwayTeam': data['AwayTeam'][match_index],
+            'market': np.array(outcomes)[outcome_index],
+            'odds': odds,
+            'model_probability': model_probabilities[market][match_index, outcome_index],
+            'closing_probability': fair_closing[match_index, outcome_index],
+            'clv': odds * fair_closing[match_index, outcome_index] - 1,
+            'return': np.where(won[match_index, outcome_index], odds - 1, -1)
+        }))
+    ledger = pd.concat(ledgers, ignore_index=True)
+    ledger['Month'] = pd.to_datetime(ledger['Date'], dayfirst=True).dt.strftime('%Y-%m')
+    return ledger
+
+def clv_summary(ledger, by):
+    # Mean CLV and realised return per unit staked, with standard errors showing how much faster CLV settles
+    if by == 'team':
+        # A bet counts towards both teams in the match
+        ledger = pd.concat([ledger.assign(team=ledger['HomeTeam']), ledger.assign(team=ledger['AwayTeam'])], ignore_index=True)
+    summary = ledger.groupby(by).agg(
+        bets=('clv', 'size'), mean_clv=('clv', 'mean'), clv_std=('clv', 'std'),
+        mean_return=('return', 'mean'), return_std=('return', 'std'))
+    summary['clv_se'] = summary.pop('clv_std') / np.sqrt(summary['bets'])
+    summary['return_se'] = summary.pop('return_std') / np.sqrt(summary['bets'])
+    return summary[['bets', 'mean_clv', 'clv_se', 'mean_return', 'return_se']]
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Closing line value of the bets the model would place")
+    parser.add_argument('league', type=str, help='Specify which league')
+    parser.add_argument('--bookmaker', type=str, default='B365', help='Bookmaker whose opening odds are bet')
+    parser.add_argument('--reference', type=str, default='PS', help='Bookmaker whose closing odds are treated as fair')
+    parser.add_argument('--margin_method', type=str, default='proportional', choices=['proportional', 'power', 'shin'],
+                        help='How the margin is removed from the closing odds')
+    parser.add_argument('--edge_threshold', type=float, default=0, help='Minimum edge over the opening odds to bet')
+    parser.add_argument('--by', type=str, nargs='+', default=['market', 'team', 'Month'], help='Groupings to summarise by')
+    parser.add_argument('--output', type=str, help='Save every bet with its CLV to this CSV file')
+    args = parser.parse_args()
+
+    params = load_parameters(args.league, './data')
+    data = load_seasons(args.league, './data', args.bookmaker, args.reference)
+    ledger = clv_ledger(data, params, args.bookmaker, args.reference, args.margin_method, args.edge_threshold)
+    if args.output is not None:
+        ledger.to_csv(args.output, index=False)
+        print(f'Ledger of {len(ledger)} bets saved as {args.output}')
+
+    print(f"{len(ledger)} bets across {ledger['Season'].nunique()} season files: "
+          f"mean CLV {ledger['clv'].mean():.4f}, mean return {ledger['return'].mean():.4f}")
+    for by in args.by:
+        print("-------------------------------------------")
+        print(clv_summary(ledger, by).round(4))
+
+
+if __name__ == "__main__":
+    main()
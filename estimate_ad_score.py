@@ -1,83 +1,51 @@
 # Author: Ng Jun Kiat
 # License: Creative Commons Attribution-NonCommercial (CC BY-NC)
 
-import requests
-from bs4 import BeautifulSoup
-import json
 import pandas as pd
 import numpy as np
-from scipy.optimize import minimize
+from predict_odds import write_parameter_file
+from predict_odds import load_parameters
+from predict_odds import variant_file_name
+from understat import fetch_league_data
+import understat
 import os
+import time
 import argparse
 
 # Code to retrieve data from URL
 
-def data_from_url(url):
-    # Send a GET request
-    response = requests.get(url)
-    
-    # Check if the request was successful
-    if response.status_code == 200:
-        print("Request Successful")
-    else:
-        print(f"Failed to retrieve the webpage. Status code: {response.status_code}")
+def data_from_url(url, offline=False):
+    # Matches on an understat league page, through the snapshot cache in understat.py
+    return fetch_league_data(url, offline)
 
-    # Scrape data
-    soup = BeautifulSoup(response.content, 'html.parser')
-    
-    # Find the script tag that contains the JSON data
-    script_tag = soup.find('script', string=lambda s: s and 'JSON.parse' in s)
-    raw_json_str = script_tag.string
-    
-    # Extract the part of the string that contains the JSON data
-    start = raw_json_str.find("JSON.parse('") + len("JSON.parse('")
-    end = raw_json_str.find("')")
-    json_str = raw_json_str[start:end]
-    
-    # Decode the JSON string
-    decoded_str = bytes(json_str, "utf-8").decode("unicode_escape")
-    data = json.loads(decoded_str)
+def data_to_df(data):
+    # Convert understat match dicts straight into typed columns, skipping fixtures that have not been played yet
+    played = [match for match in data if match.get('isResult', True)]
+    rows = [(match['h']['title'], match['a']['title'], match['goals']['h'], match['goals']['a'],
+             match['xG']['h'], match['xG']['a'], match['datetime'],
+             match['forecast']['w'], match['forecast']['d'], match['forecast']['l']) for match in played]
+    (home_team, away_team, home_goals, away_goals, home_xg, away_xg, datetime,
+     home_win_prob, draw_prob, away_win_prob) = zip(*rows) if rows else [()] * 10
 
-    return data
+    # Teams as categorical codes over one shared, sorted set of names
+    teams = sorted(set(home_team) | set(away_team))
+    team_codes = {team: code for code, team in enumerate(teams)}
+
+    def typed(values, dtype, convert=None):
+        return np.fromiter(values if convert is None else map(convert, values), dtype=dtype, count=len(values))
 
-def data_to_df(data):
-    # Initialize lists
-    home_team = []
-    away_team = []
-    home_goals = []
-    away_goals = []
-    home_xg = []
-    away_xg = []
-    datetime = []
-    home_win_prob = []
-    draw_prob = []
-    away_win_prob = []
-    
-    # Iterate through the data
-    for match in data:
-        home_team.append(match['h']['title'])
-        away_team.append(match['a']['title'])
-        home_goals.append(match['goals']['h'])
-        away_goals.append(match['goals']['a'])
-        home_xg.append(match['xG']['h'])
-        away_xg.append(match['xG']['a'])
-        datetime.append(match['datetime'])
-        home_win_prob.append(match['forecast']['w'])
-        draw_prob.append(match['forecast']['d'])
-        away_win_prob.append(match['forecast']['l'])
-    
     # Form DataFrame
     df = pd.DataFrame({
-        'home_team': home_team,
-        'away_team': away_team,
-        'home_goals': home_goals,
-        'away_goals': away_goals,
-        'home_xg': home_xg,
-        'away_xg': away_xg,
-        'datetime': datetime,
-        'home_win_prob': home_win_prob,
-        'draw_prob': draw_prob,
-        'away_win_prob': away_win_prob
+        'home_team': pd.Categorical.from_codes(typed(home_team, np.int16, team_codes.get), categories=teams),
+        'away_team': pd.Categorical.from_codes(typed(away_team, np.int16, team_codes.get), categories=teams),
+        'home_goals': typed(home_goals, np.int16, int),
+        'away_goals': typed(away_goals, np.int16, int),
+        'home_xg': typed(home_xg, np.float32, float),
+        'away_xg': typed(away_xg, np.float32, float),
+        'datetime': np.array(datetime, dtype='datetime64[s]'),
+        'home_win_prob': typed(home_win_prob, np.float32, float),
+        'draw_prob': typed(draw_prob, np.float32, float),
+        'away_win_prob': typed(away_win_prob, np.float32, float)
     })
     
     return df
@@ -94,100 +62,537 @@ def calculate_t(x, y, lambd, mil, p):
     else: 
         return 1
 
-def calculate_likelihood(parameters, df):
-    # Retrieve list of teams in alphabetical order
-    teams = np.sort(df['home_team'].unique())
-    neg_log_likelihood = 0
-    epsilon = 1e-10  # Small constant to avoid log(0)
+def decay_rate(half_life):
+    # Dixon and Coles' xi, per day, for a half-life in days; no half-life means no decay
+    if half_life is None:
+        return 0
+    return np.log(2) / half_life
+
+def match_weights(days_ago, half_life=None):
+    # Exponential down-weighting of older matches, phi(t) = exp(-xi*t)
+    return np.exp(-decay_rate(half_life) * days_ago)
 
-    # Count likelihood for each match 
-    for i in range(len(df)):
-        home_team = df.loc[i]['home_team']
-        away_team = df.loc[i]['away_team']
-        home_goals = int(df.loc[i]['home_goals'])
-        away_goals = int(df.loc[i]['away_goals'])
-        home_index = int(np.argwhere(teams == home_team)[0][0])
-        away_index = int(np.argwhere(teams == away_team)[0][0])
-        home_attack = parameters[home_index]
-        home_defence = parameters[home_index + len(teams)]
-        away_attack = parameters[away_index]
-        away_defence = parameters[away_index + len(teams)]
-        home_advantage = parameters[-2]
-        p = parameters[-1]
-
-        lambd = home_attack * away_defence * home_advantage
-        mil = away_attack * home_defence
-
-        t = calculate_t(home_goals, away_goals, lambd, mil, p)
+def encode_matches(df, half_life=None, teams=None, xg_weight=0):
+    # Encode teams to integer indices once so the likelihood can be evaluated as array operations
+    # Teams from both columns, since part of a season may not have every team at home yet,
+    # plus any teams without matches that should still get parameters (e.g. newly promoted teams)
+    teams = np.union1d(np.union1d(df['home_team'].unique(), df['away_team'].unique()), [] if teams is None else teams)
+    if 'datetime' in df:
+        # Age of each match in days, relative to the most recent one
+        datetimes = df['datetime'].to_numpy()
+        days_ago = (datetimes.max() - datetimes) / np.timedelta64(1, 'D')
+    else:
+        days_ago = np.zeros(len(df))
+    # Expected goals for the xG-based model; matches without xG (e.g. from football-data files) use their goals
+    home_xg = df['home_xg'].to_numpy(dtype=float) if 'home_xg' in df else np.full(len(df), np.nan)
+    away_xg = df['away_xg'].to_numpy(dtype=float) if 'away_xg' in df else np.full(len(df), np.nan)
+    matches = {
+        'teams': teams,
+        'home_index': pd.Categorical(df['home_team'], categories=teams).codes,
+        'away_index': pd.Categorical(df['away_team'], categories=teams).codes,
+        'home_goals': df['home_goals'].to_numpy(dtype=np.int16),
+        'away_goals': df['away_goals'].to_numpy(dtype=np.int16),
+        'home_xg': np.where(np.isnan(home_xg), df['home_goals'].to_numpy(dtype=float), home_xg),
+        'away_xg': np.where(np.isnan(away_xg), df['away_goals'].to_numpy(dtype=float), away_xg),
+        'days_ago': days_ago,
+        'weights': match_weights(days_ago, half_life),
+        'xg_weight': xg_weight
+    }
+    return matches
+
+def select_matches(matches, index, half_life=None):
+    # Subset of encoded matches, keeping every team, with ages and weights relative to the latest match kept
+    selected = dict(matches)
+    for key in ['home_index', 'away_index', 'home_goals', 'away_goals', 'home_xg', 'away_xg', 'days_ago']:
+        selected[key] = matches[key][index]
+    selected['days_ago'] = selected['days_ago'] - selected['days_ago'].min()
+    selected['weights'] = match_weights(selected['days_ago'], half_life)
+    return selected
+
+def add_promoted_prior(matches, promoted, relegated, prior_weight):
+    # Record which teams the promoted-team prior links, by index into the encoded teams
+    matches['promoted_index'] = np.searchsorted(matches['teams'], promoted)
+    matches['relegated_index'] = np.searchsorted(matches['teams'], relegated)
+    matches['prior_weight'] = prior_weight
+    return matches
+
+def promoted_prior(parameters, matches):
+    # Gaussian prior pulling each promoted team's log attacking and defending scores towards the mean of
+    # the teams they replaced, worth prior_weight matches. Returns the penalty and its gradient.
+    gradient = np.zeros_like(parameters)
+    promoted = matches.get('promoted_index', [])
+    relegated = matches.get('relegated_index', [])
+    if matches.get('prior_weight', 0) == 0 or len(promoted) == 0 or len(relegated) == 0:
+        return 0, gradient
+    num_teams = len(matches['teams'])
+    scores = np.maximum(parameters[0:num_teams*2], 1e-10).reshape(2, num_teams)
+    log_scores = np.log(scores)
+    difference = log_scores[:, promoted] - np.mean(log_scores[:, relegated], axis=1, keepdims=True)
+    penalty = matches['prior_weight'] / 2 * np.sum(difference**2)
+
+    log_gradient = np.zeros((2, num_teams))
+    log_gradient[:, promoted] += matches['prior_weight'] * difference
+    log_gradient[:, relegated] -= matches['prior_weight'] * np.sum(difference, axis=1, keepdims=True) / len(relegated)
+    gradient[0:num_teams*2] = (log_gradient / scores).ravel()
+    return penalty, gradient
+
+def promoted_prior_log_hessian(matches, num_parameters):
+    # Hessian of the promoted-team prior in log attacking and defending scores, which is constant
+    hessian = np.zeros((num_parameters, num_parameters))
+    promoted = matches.get('promoted_index', [])
+    relegated = matches.get('relegated_index', [])
+    if matches.get('prior_weight', 0) == 0 or len(promoted) == 0 or len(relegated) == 0:
+        return hessian
+    num_teams = len(matches['teams'])
+    difference = np.zeros((len(promoted), num_teams))
+    difference[np.arange(len(promoted)), promoted] = 1
+    difference[:, relegated] -= 1 / len(relegated)
+    block = matches['prior_weight'] * difference.T @ difference
+    hessian[0:num_teams, 0:num_teams] = block
+    hessian[num_teams:num_teams*2, num_teams:num_teams*2] = block
+    return hessian
 
+def calculate_t_array(home_goals, away_goals, lambd, mil, p):
+    # Vectorised version of calculate_t, applying the low-score correction with masks
+    t = np.ones_like(lambd)
+    mask_00 = (home_goals == 0) & (away_goals == 0)
+    mask_01 = (home_goals == 0) & (away_goals == 1)
+    mask_10 = (home_goals == 1) & (away_goals == 0)
+    mask_11 = (home_goals == 1) & (away_goals == 1)
+    t[mask_00] = 1 - lambd[mask_00]*mil[mask_00]*p
+    t[mask_01] = 1 + lambd[mask_01]*p
+    t[mask_10] = 1 + mil[mask_10]*p
+    t[mask_11] = 1 - p
+    return t
+
+def match_likelihoods(parameters, matches):
+    # Likelihood of every match in the season at once
+    num_teams = len(matches['teams'])
+    attack = parameters[0:num_teams]
+    defence = parameters[num_teams:num_teams*2]
+    home_advantage = parameters[-2]
+    p = parameters[-1]
+    home_index = matches['home_index']
+    away_index = matches['away_index']
+    home_goals = matches['home_goals']
+    away_goals = matches['away_goals']
+
+    lambd = attack[home_index] * defence[away_index] * home_advantage
+    mil = attack[away_index] * defence[home_index]
+
+    t = calculate_t_array(home_goals, away_goals, lambd, mil, p)
+
+    with np.errstate(invalid='ignore', over='ignore'):
         poisson_home = np.exp(-lambd) * np.power(lambd, home_goals)
         poisson_away = np.exp(-mil) * np.power(mil, away_goals)
         l = t * poisson_home * poisson_away
+    return l
+
+def xg_log_likelihoods(parameters, matches):
+    # Poisson log likelihood of each match's xG, treating xG as a continuous goal count (constant terms dropped)
+    num_teams = len(matches['teams'])
+    attack = parameters[0:num_teams]
+    defence = parameters[num_teams:num_teams*2]
+    lambd = np.maximum(attack[matches['home_index']] * defence[matches['away_index']] * parameters[-2], 1e-10)
+    mil = np.maximum(attack[matches['away_index']] * defence[matches['home_index']], 1e-10)
+    return matches['home_xg']*np.log(lambd) - lambd + matches['away_xg']*np.log(mil) - mil
+
+def calculate_likelihood(parameters, matches):
+    # Accept a raw match DataFrame as well as pre-encoded matches
+    if isinstance(matches, pd.DataFrame):
+        matches = encode_matches(matches)
+    parameters = np.asarray(parameters, dtype=float)
+    epsilon = 1e-10  # Small constant to avoid log(0)
+
+    l = match_likelihoods(parameters, matches)
+    l = np.where(np.isnan(l) | (l <= 0), epsilon, l)
+    log_l = np.log(l)
+
+    # Blend in the likelihood of the xG, for the xG-based model
+    xg_weight = matches.get('xg_weight', 0)
+    if xg_weight > 0:
+        log_l = (1 - xg_weight)*log_l + xg_weight*xg_log_likelihoods(parameters, matches)
+
+    return -np.sum(matches['weights'] * log_l) + promoted_prior(parameters, matches)[0]
+
+def calculate_t_gradient(home_goals, away_goals, lambd, mil, p):
+    # Partial derivatives of the low-score correction with respect to lambd, mil and p
+    dt_dlambd = np.zeros_like(lambd)
+    dt_dmil = np.zeros_like(lambd)
+    dt_dp = np.zeros_like(lambd)
+    mask_00 = (home_goals == 0) & (away_goals == 0)
+    mask_01 = (home_goals == 0) & (away_goals == 1)
+    mask_10 = (home_goals == 1) & (away_goals == 0)
+    mask_11 = (home_goals == 1) & (away_goals == 1)
+    dt_dlambd[mask_00] = -mil[mask_00]*p
+    dt_dmil[mask_00] = -lambd[mask_00]*p
+    dt_dp[mask_00] = -lambd[mask_00]*mil[mask_00]
+    dt_dlambd[mask_01] = p
+    dt_dp[mask_01] = lambd[mask_01]
+    dt_dmil[mask_10] = p
+    dt_dp[mask_10] = mil[mask_10]
+    dt_dp[mask_11] = -1
+    return dt_dlambd, dt_dmil, dt_dp
+
+def calculate_t_hessian(home_goals, away_goals, lambd, mil, p):
+    # Second partial derivatives of the low-score correction; t is linear in each of lambd, mil and p,
+    # so only the mixed derivatives are non-zero
+    d2t_dlambd_dmil = np.zeros_like(lambd)
+    d2t_dlambd_dp = np.zeros_like(lambd)
+    d2t_dmil_dp = np.zeros_like(lambd)
+    mask_00 = (home_goals == 0) & (away_goals == 0)
+    mask_01 = (home_goals == 0) & (away_goals == 1)
+    mask_10 = (home_goals == 1) & (away_goals == 0)
+    d2t_dlambd_dmil[mask_00] = -p
+    d2t_dlambd_dp[mask_00] = -mil[mask_00]
+    d2t_dmil_dp[mask_00] = -lambd[mask_00]
+    d2t_dlambd_dp[mask_01] = 1
+    d2t_dmil_dp[mask_10] = 1
+    return d2t_dlambd_dmil, d2t_dlambd_dp, d2t_dmil_dp
+
+def match_rate_derivatives(parameters, matches):
+    # Derivative of each match's log likelihood with respect to its lambd, mil and p, before weighting
+    num_teams = len(matches['teams'])
+    attack = parameters[0:num_teams]
+    defence = parameters[num_teams:num_teams*2]
+    home_advantage = parameters[-2]
+    p = parameters[-1]
+    home_goals = matches['home_goals']
+    away_goals = matches['away_goals']
+
+    lambd = attack[matches['home_index']] * defence[matches['away_index']] * home_advantage
+    mil = attack[matches['away_index']] * defence[matches['home_index']]
+    t = calculate_t_array(home_goals, away_goals, lambd, mil, p)
+    dt_dlambd, dt_dmil, dt_dp = calculate_t_gradient(home_goals, away_goals, lambd, mil, p)
+
+    # Matches clipped to epsilon in calculate_likelihood contribute a constant, so no gradient
+    l = match_likelihoods(parameters, matches)
+    valid = ~(np.isnan(l) | (l <= 0))
+    t_safe = np.where(valid, t, 1)
+    # goals/rate only where goals were scored: a rate pushed to its lower bound of 0 still gives a valid
+    # likelihood for a match without goals, where 0/0 would otherwise turn the whole gradient into NaN
+    home_goals_per_lambd = np.divide(home_goals, lambd, out=np.zeros_like(lambd), where=valid & (home_goals > 0))
+    away_goals_per_mil = np.divide(away_goals, mil, out=np.zeros_like(mil), where=valid & (away_goals > 0))
+
+    dlog_dlambd = np.where(valid, dt_dlambd/t_safe + home_goals_per_lambd - 1, 0)
+    dlog_dmil = np.where(valid, dt_dmil/t_safe + away_goals_per_mil - 1, 0)
+    dlog_dp = np.where(valid, dt_dp/t_safe, 0)
+
+    # The xG likelihood has no low-score correction, so only depends on lambd and mil
+    xg_weight = matches.get('xg_weight', 0)
+    if xg_weight > 0:
+        dlog_dlambd = (1 - xg_weight)*dlog_dlambd + xg_weight*(matches['home_xg']/np.maximum(lambd, 1e-10) - 1)
+        dlog_dmil = (1 - xg_weight)*dlog_dmil + xg_weight*(matches['away_xg']/np.maximum(mil, 1e-10) - 1)
+        dlog_dp = (1 - xg_weight)*dlog_dp
+    return dlog_dlambd, dlog_dmil, dlog_dp, lambd, mil
+
+def calculate_gradient(parameters, matches):
+    # Closed-form gradient of the negative log likelihood
+    if isinstance(matches, pd.DataFrame):
+        matches = encode_matches(matches)
+    parameters = np.asarray(parameters, dtype=float)
+    num_teams = len(matches['teams'])
+    attack = parameters[0:num_teams]
+    defence = parameters[num_teams:num_teams*2]
+    home_advantage = parameters[-2]
+    home_index = matches['home_index']
+    away_index = matches['away_index']
 
-        if np.isnan(l) or l <= 0:
-            l = epsilon
+    # Derivative of the weighted log likelihood of each match with respect to lambd, mil and p
+    dlog_dlambd, dlog_dmil, dlog_dp, lambd, mil = match_rate_derivatives(parameters, matches)
+    weights = matches['weights']
+    dlog_dlambd = weights*dlog_dlambd
+    dlog_dmil = weights*dlog_dmil
+    dlog_dp = weights*dlog_dp
 
-        neg_log_likelihood += -np.log(l)
+    # Chain rule through lambd = home_attack*away_defence*home_advantage and mil = away_attack*home_defence
+    gradient = np.zeros_like(parameters)
+    gradient[0:num_teams] = (np.bincount(home_index, weights=dlog_dlambd*defence[away_index]*home_advantage, minlength=num_teams)
+                             + np.bincount(away_index, weights=dlog_dmil*defence[home_index], minlength=num_teams))
+    gradient[num_teams:num_teams*2] = (np.bincount(away_index, weights=dlog_dlambd*attack[home_index]*home_advantage, minlength=num_teams)
+                                       + np.bincount(home_index, weights=dlog_dmil*attack[away_index], minlength=num_teams))
+    gradient[-2] = np.sum(dlog_dlambd*attack[home_index]*defence[away_index])
+    gradient[-1] = np.sum(dlog_dp)
 
-    return neg_log_likelihood
+    return -gradient + promoted_prior(parameters, matches)[1]
 
 # Define the optimization function
-def objective_function(parameters, df):
-    return calculate_likelihood(parameters, df)
-
-
-def estimate_ad_score(league):
-    url = ''
-    if league == 'EPL':
-        url = 'https://understat.com/league/EPL/2023'
-    elif league == 'LaLiga':
-        url = 'https://understat.com/league/La_liga/2023'
-    elif league == 'Bundesliga':
-        url = 'https://understat.com/league/Bundesliga/2023'
-    elif league == 'Ligue1':
-        url = 'https://understat.com/league/Ligue_1/2023'
-    elif league == 'SerieA':
-        url = 'https://understat.com/league/Serie_A/2023'
-    else: 
-        raise Exception('League not found.')
-    data = data_from_url(url)
-    df = data_to_df(data)
+def objective_function(parameters, matches):
+    return calculate_likelihood(parameters, matches)
+
+def objective_function_and_gradient(parameters, matches):
+    return calculate_likelihood(parameters, matches), calculate_gradient(parameters, matches)
+
+def check_gradient(parameters, matches):
+    # Relative difference between the closed-form gradient and finite differences of the likelihood, at the
+    # given parameters and with the weakest attacking score on its lower bound of 0, where the optimiser can
+    # stop early if zero expected goals break the gradient. Finite differences across the clipped likelihood
+    # of the bound coordinate itself are meaningless, so only the other coordinates are compared there.
+    from scipy.optimize import approx_fprime
+
+    def relative_difference(point, compared):
+        approx_gradient = approx_fprime(point, calculate_likelihood, 1e-6, matches)
+        gradient = calculate_gradient(point, matches)
+        return np.max(np.abs(gradient - approx_gradient)[compared]) / max(1, np.max(np.abs(approx_gradient[compared])))
+
+    num_teams = len(matches['teams'])
+    parameters = np.asarray(parameters, dtype=float)
+    on_bound = parameters.copy()
+    on_bound[np.argmin(parameters[0:num_teams])] = 0
+    return (relative_difference(parameters, np.ones(len(parameters), dtype=bool)),
+            relative_difference(on_bound, on_bound > 0))
 
-    # Initial guess
-    num_teams = len(df['home_team'].unique())
-    initial_guess = np.ones(2 * num_teams + 2) # Initialise all attacking and defending scores to 1
-    initial_guess[-1] = 0 # Initialise p to 0 
+def log_to_parameters(log_parameters, num_teams):
+    # Centre the log attacking scores so that their geometric mean is 1, which fixes the attack/defence scale
+    log_attack = log_parameters[0:num_teams] - np.mean(log_parameters[0:num_teams])
+    parameters = np.empty_like(log_parameters)
+    parameters[0:num_teams] = np.exp(log_attack)
+    parameters[num_teams:num_teams*2] = np.exp(log_parameters[num_teams:num_teams*2])
+    parameters[-2] = np.exp(log_parameters[-2])
+    parameters[-1] = log_parameters[-1]
+    return parameters
+
+def parameters_to_log(parameters, num_teams):
+    # Inverse of log_to_parameters; the defending scores absorb the centring of the attacking scores
+    # so that every expected goal count is unchanged
+    log_parameters = np.empty_like(parameters)
+    log_attack = np.log(np.maximum(parameters[0:num_teams], 1e-10))
+    log_parameters[0:num_teams] = log_attack - np.mean(log_attack)
+    log_parameters[num_teams:num_teams*2] = np.log(np.maximum(parameters[num_teams:num_teams*2], 1e-10)) + np.mean(log_attack)
+    log_parameters[-2] = np.log(np.maximum(parameters[-2], 1e-10))
+    log_parameters[-1] = parameters[-1]
+    return log_parameters
+
+def log_objective_function_and_gradient(log_parameters, matches):
+    # Negative log likelihood and gradient in terms of log attack, log defence, log home advantage and p
+    num_teams = len(matches['teams'])
+    parameters = log_to_parameters(log_parameters, num_teams)
+    gradient = calculate_gradient(parameters, matches)
+    log_gradient = gradient * parameters
+    log_gradient[-1] = gradient[-1]
+    # Project out the direction removed by centring the log attacking scores
+    log_gradient[0:num_teams] -= np.mean(log_gradient[0:num_teams])
+    return calculate_likelihood(parameters, matches), log_gradient
+
+def fit_parameters(matches, analytic_gradient=True, log_parameters=False, initial_guess=None):
+    # Imported here so the likelihood functions can be used without scipy
+    from scipy.optimize import minimize
+
+    # Initial guess, unless warm-starting from previous parameters
+    num_teams = len(matches['teams'])
+    warm_start = initial_guess is not None
+    if not warm_start:
+        initial_guess = np.ones(2 * num_teams + 2) # Initialise all attacking and defending scores to 1
+        initial_guess[-1] = 0 # Initialise p to 0 
     bounds = [(0, None)] * (2 * num_teams + 2)  # Adjust bounds
 
-    print('Optimisation in Progress')
-    # Run the optimization
-    result = minimize(
-        objective_function,
-        initial_guess,
-        args=(df,),
-        method='L-BFGS-B',
-        bounds=bounds,
-        options={'maxiter': 15}
-    )
-    # Output the optimized parameters
-    optimised_parameters = result.x
-    print(f'Optimisation Complete. Negative log likelihood = {result.fun}')
-    
+    start_time = time.perf_counter()
+    if log_parameters:
+        # Optimise log scores from 0, so p is no longer started on a boundary
+        log_initial_guess = np.zeros(2 * num_teams + 2)
+        if warm_start:
+            log_initial_guess = parameters_to_log(initial_guess, num_teams)
+        result = minimize(
+            log_objective_function_and_gradient,
+            log_initial_guess,
+            args=(matches,),
+            method='L-BFGS-B',
+            jac=True
+        )
+        optimised_parameters = log_to_parameters(result.x, num_teams)
+        gradient_norm = np.linalg.norm(log_objective_function_and_gradient(result.x, matches)[1])
+    else:
+        # Run the optimization, using the closed-form gradient unless finite differences are requested
+        if analytic_gradient:
+            result = minimize(
+                objective_function_and_gradient,
+                initial_guess,
+                args=(matches,),
+                method='L-BFGS-B',
+                jac=True,
+                bounds=bounds
+            )
+        else:
+            result = minimize(
+                objective_function,
+                initial_guess,
+                args=(matches,),
+                method='L-BFGS-B',
+                bounds=bounds
+            )
+        optimised_parameters = result.x
+        # Ignore gradient components pushing against the lower bound
+        gradient = calculate_gradient(optimised_parameters, matches)
+        gradient[(optimised_parameters <= 0) & (gradient > 0)] = 0
+        gradient_norm = np.linalg.norm(gradient)
+    wall_time = time.perf_counter() - start_time
+
+    report = {
+        'mode': 'log' if log_parameters else 'bounded',
+        'warm_start': warm_start,
+        'success': bool(result.success),
+        'message': str(result.message),
+        'iterations': int(result.nit),
+        'function_evaluations': int(result.nfev),
+        'wall_time': wall_time,
+        'gradient_norm': float(gradient_norm),
+        'neg_log_likelihood': float(result.fun)
+    }
+    return optimised_parameters, report
+
+def match_log_curvature(parameters, matches):
+    # Gradient and Hessian pieces of every match's unweighted log likelihood in log scores (log attack,
+    # log defence, log home advantage and p). A match only depends on its log lambd, log mil and p, so
+    # each one is a few numbers spread over the teams that played it, reusable with any match weights.
+    num_teams = len(matches['teams'])
+    num_matches = len(matches['home_index'])
+    rows = np.arange(num_matches)
+    # log lambd = log home attack + log away defence + log home advantage, log mil = log away attack + log home defence
+    jacobian_lambd = np.zeros((num_matches, 2 * num_teams + 2))
+    jacobian_lambd[rows, matches['home_index']] = 1
+    jacobian_lambd[rows, num_teams + matches['away_index']] = 1
+    jacobian_lambd[:, -2] = 1
+    jacobian_mil = np.zeros((num_matches, 2 * num_teams + 2))
+    jacobian_mil[rows, matches['away_index']] = 1
+    jacobian_mil[rows, num_teams + matches['home_index']] = 1
+
+    dlog_dlambd, dlog_dmil, dlog_dp, lambd, mil = match_rate_derivatives(parameters, matches)
+    gradients = jacobian_lambd*(lambd*dlog_dlambd)[:, None] + jacobian_mil*(mil*dlog_dmil)[:, None]
+    gradients[:, -1] = dlog_dp
+
+    # Second derivatives of log t, then of the goals likelihood in log lambd and log mil
+    home_goals = matches['home_goals']
+    away_goals = matches['away_goals']
+    p = parameters[-1]
+    t = calculate_t_array(home_goals, away_goals, lambd, mil, p)
+    dt_dlambd, dt_dmil, dt_dp = calculate_t_gradient(home_goals, away_goals, lambd, mil, p)
+    d2t_dlambd_dmil, d2t_dlambd_dp, d2t_dmil_dp = calculate_t_hessian(home_goals, away_goals, lambd, mil, p)
+    l = match_likelihoods(parameters, matches)
+    valid = ~(np.isnan(l) | (l <= 0))
+    t_safe = np.where(valid, t, 1)
+    dlogt_dlambd = dt_dlambd/t_safe
+    dlogt_dmil = dt_dmil/t_safe
+    dlogt_dp = dt_dp/t_safe
+    xg_weight = matches.get('xg_weight', 0)
+    goals_weight = np.where(valid, 1 - xg_weight, 0)
+    # The Poisson terms of both the goals and the xG likelihood contribute -lambd and -mil
+    curvature = {
+        'jacobian_lambd': jacobian_lambd,
+        'jacobian_mil': jacobian_mil,
+        'gradients': gradients,
+        'lambd_lambd': goals_weight*(lambd*dlogt_dlambd - (lambd*dlogt_dlambd)**2 - lambd) - xg_weight*lambd,
+        'mil_mil': goals_weight*(mil*dlogt_dmil - (mil*dlogt_dmil)**2 - mil) - xg_weight*mil,
+        'lambd_mil': goals_weight*lambd*mil*(d2t_dlambd_dmil/t_safe - dlogt_dlambd*dlogt_dmil),
+        'lambd_p': goals_weight*lambd*(d2t_dlambd_dp/t_safe - dlogt_dlambd*dlogt_dp),
+        'mil_p': goals_weight*mil*(d2t_dmil_dp/t_safe - dlogt_dmil*dlogt_dp),
+        'p_p': -goals_weight*dlogt_dp**2
+    }
+    return curvature
+
+def newton_step_parameters(parameters, matches, curvature, weights, bounded=True):
+    # Parameters after one Newton step on the likelihood with the matches reweighted, starting from
+    # parameters fitted with other weights. The attack/defence scale has no curvature, and the
+    # least-squares step leaves it unchanged.
+    num_teams = len(matches['teams'])
+    jacobian_lambd = curvature['jacobian_lambd']
+    jacobian_mil = curvature['jacobian_mil']
+    gradient = curvature['gradients'].T @ weights
+    hessian = (jacobian_lambd.T @ (jacobian_lambd*(weights*curvature['lambd_lambd'])[:, None])
+               + jacobian_mil.T @ (jacobian_mil*(weights*curvature['mil_mil'])[:, None]))
+    cross = jacobian_lambd.T @ (jacobian_mil*(weights*curvature['lambd_mil'])[:, None])
+    hessian += cross + cross.T
+    p_column = jacobian_lambd.T @ (weights*curvature['lambd_p']) + jacobian_mil.T @ (weights*curvature['mil_p'])
+    hessian[:, -1] += p_column
+    hessian[-1, :] += p_column
+    hessian[-1, -1] += np.sum(weights*curvature['p_p'])
+
+    # The prior is part of the negative log likelihood, so its gradient and Hessian are subtracted
+    prior_gradient = promoted_prior(parameters, matches)[1]
+    prior_gradient[0:num_teams*2] *= parameters[0:num_teams*2]
+    gradient -= prior_gradient
+    hessian -= promoted_prior_log_hessian(matches, len(parameters))
+
+    # Parameters on their lower bounds stay there: scores pushed to 0, and with bounded fits p at 0
+    # when the likelihood would move it further down. They are left out of the system, not clamped
+    # afterwards, so the other parameters do not compensate for a move that cannot happen.
+    free = parameters > 1e-10
+    free[-1] = not bounded or parameters[-1] > 0 or gradient[-1] > 0
+
+    def solve(free):
+        step = np.zeros_like(parameters)
+        step[free] = np.linalg.lstsq(-hessian[np.ix_(free, free)], gradient[free], rcond=None)[0]
+        return step
+
+    step = solve(free)
+    if bounded and parameters[-1] + step[-1] < 0:
+        free[-1] = False
+        step = solve(free)
+    stepped = np.empty_like(parameters)
+    stepped[0:-1] = np.exp(np.log(np.maximum(parameters[0:-1], 1e-10)) + step[0:-1])
+    stepped[-1] = parameters[-1] + step[-1]
+    return stepped
+
+# Candidate half-lives in days for --search_half_life, from about two months to no decay
+SEARCH_HALF_LIVES = [60, 120, 240, 480, np.inf]
+
+def search_half_life(matches, half_lives, num_folds=5, log_parameters=False):
+    # Choose the half-life by how well each one predicts later matches (Dixon and Coles, section 4.5).
+    # The later half of the matches is split into folds; each fold is predicted from the matches before it.
+    # Each fold is fitted once, with the middle candidate half-life. The other candidates reuse the
+    # per-match gradients and curvatures of that fit, taking one Newton step with their own weights.
+    order = np.argsort(-matches['days_ago'], kind='stable')
+    folds = np.array_split(order[len(order)//2:], num_folds)
+    half_lives = sorted(half_lives, reverse=True)
+    fitted_half_life = half_lives[len(half_lives)//2]
+    held_out = np.zeros(len(half_lives))
+    function_evaluations = 0
+    for fold in folds:
+        train = select_matches(matches, np.flatnonzero(matches['days_ago'] > matches['days_ago'][fold].max()), fitted_half_life)
+        test = select_matches(matches, fold)
+        parameters, report = fit_parameters(train, log_parameters=log_parameters)
+        function_evaluations += report['function_evaluations']
+        curvature = match_log_curvature(parameters, train)
+        for i, half_life in enumerate(half_lives):
+            stepped = newton_step_parameters(parameters, train, curvature, match_weights(train['days_ago'], half_life),
+                                             bounded=not log_parameters)
+            l = match_likelihoods(stepped, test)
+            held_out[i] += np.sum(np.log(np.where(np.isnan(l) | (l <= 0), 1e-10, l)))
+    print(f'Half-life search: {num_folds} fits with a half-life of {fitted_half_life} days, '
+          f'{function_evaluations} function evaluations')
+    return pd.DataFrame({
+        'half_life': half_lives,
+        'xi': [decay_rate(half_life) for half_life in half_lives],
+        'held_out_log_likelihood': held_out
+    })
+
+
+def atomic_write(path, write):
+    # Write to a temporary file next to path and rename it into place, so readers never see a partial file
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    write(temporary_path)
+    os.replace(temporary_path, path)
+
+def save_parameters(league, teams, optimised_parameters, report, csv=False, variant=None):
+    num_teams = len(teams)
+
     # Save parameters as DataFrames
     df_attacking_scores = pd.DataFrame({
-        'team': np.sort(df['home_team'].unique()),
+        'team': teams,
         'attacking_score': optimised_parameters[0:num_teams]})
     df_defending_scores = pd.DataFrame({
-        'team': np.sort(df['home_team'].unique()),
+        'team': teams,
         'defending_score': optimised_parameters[num_teams:num_teams*2]})
     df_home_advantage = pd.DataFrame({
         'parameter': ['home_advantage', 'p'],
         'value': optimised_parameters[num_teams*2:num_teams*2+2]})
+    df_convergence_report = pd.DataFrame({
+        'metric': list(report.keys()),
+        'value': list(report.values())})
 
-    # Create 'data' directory if it doesn't exist
+    # Create 'data' directory if it doesn't exist (leagues may be saved in parallel, so tolerate a race)
     data_dir = 'data'
     if not os.path.exists(data_dir):
-        os.makedirs(data_dir)
+        os.makedirs(data_dir, exist_ok=True)
         print(f"'{data_dir}' directory created.")
     
     # Define the 'data_<league>' directory
@@ -195,31 +600,295 @@ def estimate_ad_score(league):
     
     # Create 'data_<league>' directory if it doesn't exist
     if not os.path.exists(league_dir):
-        os.makedirs(league_dir)
+        os.makedirs(league_dir, exist_ok=True)
         print(f"'{league_dir}' directory created.")
     else:
         print(f"'{league_dir}' already exists.")
     
-    # Save the DataFrames as CSV files in the 'data' folder
-    attacking_scores_csv_path = os.path.join('data', 'data_'+league, 'attacking_scores.csv')
-    df_attacking_scores.to_csv(attacking_scores_csv_path, index=False)
-    print(f"Attacking Scores saved as {attacking_scores_csv_path}")
-    
-    defending_scores_csv_path = os.path.join('data', 'data_'+league, 'defending_scores.csv')
-    df_defending_scores.to_csv(defending_scores_csv_path, index=False)
-    print(f"Defending Scores saved as {defending_scores_csv_path}")
+    convergence_report_csv_path = os.path.join('data', 'data_'+league, variant_file_name('convergence_report.csv', variant))
+    atomic_write(convergence_report_csv_path, lambda path: df_convergence_report.to_csv(path, index=False))
+    print(f"Convergence Report saved as {convergence_report_csv_path}")
+
+    if csv:
+        # Save the DataFrames as CSV files in the 'data' folder
+        attacking_scores_csv_path = os.path.join('data', 'data_'+league, variant_file_name('attacking_scores.csv', variant))
+        atomic_write(attacking_scores_csv_path, lambda path: df_attacking_scores.to_csv(path, index=False))
+        print(f"Attacking Scores saved as {attacking_scores_csv_path}")
+        
+        defending_scores_csv_path = os.path.join('data', 'data_'+league, variant_file_name('defending_scores.csv', variant))
+        atomic_write(defending_scores_csv_path, lambda path: df_defending_scores.to_csv(path, index=False))
+        print(f"Defending Scores saved as {defending_scores_csv_path}")
+        
+        home_advantage_csv_path = os.path.join('data', 'data_'+league, variant_file_name('home_advantage.csv', variant))
+        atomic_write(home_advantage_csv_path, lambda path: df_home_advantage.to_csv(path, index=False))
+        print(f"Home Advantage saved as {home_advantage_csv_path}")
+
+    # Save the parameters as a binary parameter file last, as it is what the odds calculators read first
+    parameter_file_path = os.path.join('data', 'data_'+league, variant_file_name('parameters.bin', variant))
+    atomic_write(parameter_file_path, lambda path: write_parameter_file(path, teams, optimised_parameters))
+    print(f"Parameters saved as {parameter_file_path}")
+
+# understat's name for each league
+LEAGUE_URL_NAMES = {
+    'EPL': 'EPL',
+    'LaLiga': 'La_liga',
+    'Bundesliga': 'Bundesliga',
+    'Ligue1': 'Ligue_1',
+    'SerieA': 'Serie_A'
+}
+
+def league_url(league, season=2023):
+    if league not in LEAGUE_URL_NAMES:
+        raise Exception('League not found.')
+    return f'{understat.BASE_URL}/league/{LEAGUE_URL_NAMES[league]}/{season}'
+
+def fetch_seasons(league, seasons, offline=False):
+    # Played matches of every season, and the teams in each season's fixture list (unplayed fixtures included)
+    dfs = []
+    season_teams = {}
+    for season in seasons:
+        data = data_from_url(league_url(league, season), offline)
+        season_teams[season] = {match['h']['title'] for match in data} | {match['a']['title'] for match in data}
+        df = data_to_df(data)
+        df['league'] = league
+        df['season'] = season
+        dfs.append(df)
+    df = pd.concat(dfs, ignore_index=True)
+    # Seasons have different teams, so stacking them loses the categories; share one set again
+    teams = sorted(set(df['home_team']) | set(df['away_team']))
+    df['home_team'] = pd.Categorical(df['home_team'], categories=teams)
+    df['away_team'] = pd.Categorical(df['away_team'], categories=teams)
+    return df, season_teams
+
+def read_match_file(path):
+    # Extra matches from a local CSV, either saved by this script (matches.csv) or a football-data.co.uk file
+    df = pd.read_csv(path, encoding='utf-8-sig')
+    if 'HomeTeam' in df:
+        from betting_odds import normalise_team_names
+        datetimes = df['Date'] + ' ' + df['Time'] if 'Time' in df else df['Date']
+        df = pd.DataFrame({
+            'datetime': pd.to_datetime(datetimes, dayfirst=True),
+            'home_team': normalise_team_names(df['HomeTeam']),
+            'away_team': normalise_team_names(df['AwayTeam']),
+            'home_goals': df['FTHG'],
+            'away_goals': df['FTAG']
+        }).dropna().astype({'home_goals': np.int16, 'away_goals': np.int16})
+    else:
+        df['datetime'] = pd.to_datetime(df['datetime'])
+    if 'league' not in df:
+        df['league'] = os.path.splitext(os.path.basename(path))[0]
+    return df
+
+def promoted_teams(season_teams):
+    # Teams in the latest season that were not in the season before, and the teams they replaced
+    seasons = sorted(season_teams)
+    if len(seasons) < 2:
+        return [], []
+    latest = season_teams[seasons[-1]]
+    previous = season_teams[seasons[-2]]
+    return sorted(latest - previous), sorted(previous - latest)
+
+def save_matches(league, df, variant=None):
+    # Keep the matches behind the saved parameters, so later updates only need to add new results.
+    # Each variant keeps its own history, since each one is fitted and updated separately.
+    matches_csv_path = os.path.join('data', 'data_'+league, variant_file_name('matches.csv', variant))
+    columns = [column for column in ['datetime', 'home_team', 'away_team', 'home_goals', 'away_goals', 'home_xg', 'away_xg', 'league', 'season']
+               if column in df]
+    atomic_write(matches_csv_path, lambda path: df[columns].to_csv(path, index=False))
+    print(f"Matches saved as {matches_csv_path}")
+
+def load_previous_fit(league, variant=None):
+    # Previously fitted matches and parameters, or None if the league has not been fitted with its matches saved
+    matches_csv_path = os.path.join('data', 'data_'+league, variant_file_name('matches.csv', variant))
+    parameter_file_path = os.path.join('data', 'data_'+league, variant_file_name('parameters.bin', variant))
+    if not os.path.exists(matches_csv_path) or not os.path.exists(parameter_file_path):
+        return None
+    df_previous = pd.read_csv(matches_csv_path, dtype={'home_goals': np.int16, 'away_goals': np.int16}, parse_dates=['datetime'])
+    return df_previous, load_parameters(league, 'data', variant)
+
+def warm_start_parameters(teams, params):
+    # Previous parameters reordered for the current teams; teams without a previous rating start at 1
+    initial_guess = np.ones(2 * len(teams) + 2)
+    for i, team in enumerate(teams):
+        if team in params['team_index']:
+            initial_guess[i] = params['attack'][params['team_index'][team]]
+            initial_guess[i + len(teams)] = params['defence'][params['team_index'][team]]
+    initial_guess[-2] = params['home_advantage']
+    initial_guess[-1] = params['p']
+    return initial_guess
+
+def new_matches(df, df_previous):
+    # Rows of df that are not already in df_previous
+    key = ['datetime', 'home_team', 'away_team']
+    merged = df.merge(df_previous[key], on=key, how='left', indicator=True)
+    return df[(merged['_merge'] == 'left_only').to_numpy()]
+
+def compare_with_full_refit(matches, optimised_parameters, report, analytic_gradient=True, log_parameters=False):
+    # Refit the same matches from scratch and report how far the warm-started fit is from it
+    full_parameters, full_report = fit_parameters(matches, analytic_gradient, log_parameters)
+    num_teams = len(matches['teams'])
+    # Compare expected goals, which do not depend on how the attack/defence scale is fixed
+    lambd = np.outer(optimised_parameters[0:num_teams], optimised_parameters[num_teams:num_teams*2])
+    full_lambd = np.outer(full_parameters[0:num_teams], full_parameters[num_teams:num_teams*2])
+    print(f'Full refit: negative log likelihood = {full_report["neg_log_likelihood"]}, '
+          f'function evaluations: {full_report["function_evaluations"]}, time: {full_report["wall_time"]:.3f}s')
+    print(f'Incremental minus full negative log likelihood: {report["neg_log_likelihood"] - full_report["neg_log_likelihood"]:.3g}')
+    print(f'Largest relative difference in expected goals: {np.max(np.abs(lambd/full_lambd - 1)):.3g}')
+
+def estimate_ad_score(league, analytic_gradient=True, check=False, log_parameters=False, csv=False, seasons=(2023,),
+                      incremental=False, compare=False, half_life=None, search_half_lives=None, match_files=(), prior_weight=5,
+                      fetched=None, offline=False, xg_weight=0):
+    check_xg_weight(xg_weight)
+    # Matches may already have been fetched, e.g. by estimate_all_leagues
+    df, season_teams = fetch_seasons(league, seasons, offline) if fetched is None else fetched
+    # Other leagues (e.g. the second tier) are fitted jointly, linked by the teams that move between them
+    for path in match_files:
+        df = pd.concat([df, read_match_file(path)], ignore_index=True)
+    promoted, relegated = promoted_teams(season_teams)
+    if promoted:
+        print(f'Promoted teams: {", ".join(promoted)}')
+
+    # Warm-start from the saved parameters, adding only matches that were not in the previous fit
+    initial_guess = None
+    # Fits that use xG are saved as the 'xg' variant, alongside the goal-based parameters
+    variant = 'xg' if xg_weight > 0 else None
+    previous_fit = load_previous_fit(league, variant) if incremental else None
+    if previous_fit is not None:
+        df_previous, previous_params = previous_fit
+        df_new = new_matches(df, df_previous)
+        if len(df_new) == 0:
+            print('No new matches since the last fit.')
+            return None
+        print(f'Adding {len(df_new)} new matches to the {len(df_previous)} previously fitted')
+        df = pd.concat([df_previous, df_new], ignore_index=True)
+    elif incremental:
+        print('No previous fit with saved matches found, fitting from scratch')
+    matches = add_promoted_prior(encode_matches(df, teams=promoted, xg_weight=xg_weight), promoted, relegated, prior_weight)
+    print(f'Fitting {len(matches["teams"])} teams to {len(df)} matches')
+    if search_half_lives is not None:
+        search = search_half_life(matches, search_half_lives or SEARCH_HALF_LIVES, log_parameters=log_parameters)
+        print(search)
+        half_life = search['half_life'][search['held_out_log_likelihood'].idxmax()]
+        print(f'Best half-life: {half_life} days')
+    if half_life is not None:
+        matches['weights'] = match_weights(matches['days_ago'], half_life)
+    if previous_fit is not None:
+        initial_guess = warm_start_parameters(matches['teams'], previous_params)
+
+    print('Optimisation in Progress')
+    optimised_parameters, report = fit_parameters(matches, analytic_gradient, log_parameters, initial_guess)
+    report['half_life'] = half_life
+    report['xg_weight'] = xg_weight
+    # Output the optimized parameters
+    print(f'Optimisation Complete. Negative log likelihood = {report["neg_log_likelihood"]}')
+    print(f'Iterations: {report["iterations"]}, function evaluations: {report["function_evaluations"]}, '
+          f'time: {report["wall_time"]:.3f}s, gradient norm: {report["gradient_norm"]:.3g}')
+    if not report['success']:
+        print(f'Warning: optimisation did not converge ({report["message"]})')
+    if check:
+        at_optimum, on_bound = check_gradient(optimised_parameters, matches)
+        print(f'Gradient check: relative difference to finite differences = {at_optimum} at the fitted parameters, '
+              f'{on_bound} with an attacking score on its lower bound')
+    if compare:
+        compare_with_full_refit(matches, optimised_parameters, report, analytic_gradient, log_parameters)
     
-    home_advantage_csv_path = os.path.join('data', 'data_'+league, 'home_advantage.csv')
-    df_home_advantage.to_csv(home_advantage_csv_path, index=False)
-    print(f"Home Advantage saved as {home_advantage_csv_path}")
-    return
+    save_parameters(league, matches['teams'], optimised_parameters, report, csv, variant)
+    save_matches(league, df, variant)
+    return report
+
+def check_xg_weight(xg_weight):
+    # The goals and xG log likelihoods are blended with weights 1-xg_weight and xg_weight
+    if not 0 <= xg_weight <= 1:
+        raise ValueError(f'xg_weight must be between 0 and 1, got {xg_weight}')
+
+def xg_weight_argument(value):
+    # argparse type for --xg_weight
+    xg_weight = float(value)
+    if not 0 <= xg_weight <= 1:
+        raise argparse.ArgumentTypeError(f'must be between 0 and 1, got {xg_weight}')
+    return xg_weight
+
+def import_optimiser():
+    # Warm-up task, so worker processes import scipy while the leagues are still being fetched
+    import scipy.optimize
+
+def timed_estimate(league, fetched, options):
+    # Fit and save one league in a worker process, returning how long it took
+    start_time = time.perf_counter()
+    report = estimate_ad_score(league, fetched=fetched, **options)
+    return report, time.perf_counter() - start_time
+
+def estimate_all_leagues(leagues=tuple(LEAGUE_URL_NAMES), seasons=(2023,), workers=None, **options):
+    # Scrape every league on a thread pool and fit each one on a process pool as soon as its data arrives
+    check_xg_weight(options.get('xg_weight', 0))
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+    def timed_fetch(league):
+        start_time = time.perf_counter()
+        fetched = fetch_seasons(league, seasons, options.get('offline', False))
+        return fetched, time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    timings = {}
+    workers = workers or min(len(leagues), os.cpu_count())
+    with ThreadPoolExecutor(max_workers=len(leagues)) as fetch_pool, ProcessPoolExecutor(max_workers=workers) as fit_pool:
+        for _ in range(workers):
+            fit_pool.submit(import_optimiser)
+        fetches = {fetch_pool.submit(timed_fetch, league): league for league in leagues}
+        fits = {}
+        for future in as_completed(fetches):
+            league = fetches[future]
+            fetched, fetch_time = future.result()
+            timings[league] = {'fetch': fetch_time}
+            fits[fit_pool.submit(timed_estimate, league, fetched, dict(options, seasons=seasons))] = league
+        for future in as_completed(fits):
+            league = fits[future]
+            report, timings[league]['fit_and_save'] = future.result()
+            timings[league]['optimisation'] = np.nan if report is None else report['wall_time']
+    timings = pd.DataFrame(timings).T.loc[list(leagues), ['fetch', 'fit_and_save', 'optimisation']]
+    print("-------------------------------------------")
+    print('Time per league (s)')
+    print(timings.round(3))
+    print(f'Total time: {time.perf_counter() - start_time:.3f}s')
+    return timings
 
 def main():
     # Set up argument parser
     parser = argparse.ArgumentParser(description="Estimate Attacking and Defending Score of teams")
-    parser.add_argument('league', type=str, help='Specify which league')
+    parser.add_argument('league', type=str, nargs='?', help='Specify which league')
+    parser.add_argument('--numerical_gradient', action='store_true', help='Use finite differences instead of the closed-form gradient')
+    parser.add_argument('--check_gradient', action='store_true', help='Compare the closed-form gradient against finite differences, at the fit and on a lower bound')
+    parser.add_argument('--log_parameters', action='store_true', help='Optimise log scores with attacking scores centred on 1')
+    parser.add_argument('--csv', action='store_true', help='Also save the parameters as CSV files')
+    parser.add_argument('--season', type=int, nargs='+', default=[2023], help='Seasons to fit jointly, by the year each starts in')
+    parser.add_argument('--match_files', type=str, nargs='+', default=[],
+                        help='Extra matches to fit jointly, from matches.csv or football-data.co.uk CSV files (e.g. the second tier)')
+    parser.add_argument('--prior_weight', type=float, default=5,
+                        help='Weight, in matches, of the prior that promoted teams are like the teams they replaced')
+    parser.add_argument('--incremental', action='store_true', help='Add new results to the previous fit and warm-start from its parameters')
+    parser.add_argument('--compare_full_refit', action='store_true', help='Also refit from scratch and compare with the result')
+    parser.add_argument('--xg_weight', type=xg_weight_argument, default=0,
+                        help="Weight of the xG likelihood against the goals likelihood, from 0 (goals only) to 1 (xG only); saved as the 'xg' variant")
+    parser.add_argument('--half_life', type=float, help='Down-weight older matches, halving their weight every this many days')
+    parser.add_argument('--search_half_life', type=float, nargs='*',
+                        help='Choose the half-life from these candidates (days, inf for no decay) by predicting later matches, with one fit per fold and a Newton step per candidate')
+    parser.add_argument('--all_leagues', '--all-leagues', action='store_true', help='Fetch and fit all five leagues in parallel')
+    parser.add_argument('--offline', action='store_true', help='Use the saved snapshots of understat pages instead of the network')
+    parser.add_argument('--workers', type=int, help='Number of processes fitting leagues in parallel (default: one per league, up to one per CPU)')
     args = parser.parse_args()
-    estimate_ad_score(args.league)
+    options = dict(analytic_gradient=not args.numerical_gradient, check=args.check_gradient,
+                   log_parameters=args.log_parameters, csv=args.csv,
+                   incremental=args.incremental, compare=args.compare_full_refit, half_life=args.half_life,
+                   search_half_lives=args.search_half_life, prior_weight=args.prior_weight, offline=args.offline,
+                   xg_weight=args.xg_weight)
+    if args.all_leagues:
+        if args.match_files:
+            parser.error('--match_files belong to one league and cannot be used with --all_leagues')
+        estimate_all_leagues(seasons=args.season, workers=args.workers, **options)
+    elif args.league is None:
+        parser.error('Specify a league or --all_leagues')
+    else:
+        estimate_ad_score(args.league, seasons=args.season, match_files=args.match_files, **options)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,148 @@
+from predict_odds import load_parameters
+from predict_odds import fixture_probability_array
+from predict_odds import match_odds
+from predict_odds import over_under_odds
+from predict_odds import both_to_score
+from predict_odds import result_both_to_score
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode
+from urllib.request import urlopen
+from urllib.error import HTTPError
+import threading
+import traceback
+import argparse
+import json
+import time
+import os
+
+LEAGUES = ['EPL', 'LaLiga', 'SerieA', 'Bundesliga', 'Ligue1']
+PARAMETER_CSVS = ['attacking_scores.csv', 'defending_scores.csv', 'home_advantage.csv']
+
+def league_mtimes(data_dir, league):
+    # Modification times of the files load_parameters reads: parameters.bin when it exists, otherwise the
+    # CSV files. None if the league has neither.
+    league_dir = os.path.join(data_dir, 'data_'+league)
+    parameter_file_path = os.path.join(league_dir, 'parameters.bin')
+    if os.path.exists(parameter_file_path):
+        return (os.stat(parameter_file_path).st_mtime_ns,)
+    mtimes = []
+    for file in PARAMETER_CSVS:
+        path = os.path.join(league_dir, file)
+        mtimes.append(os.stat(path).st_mtime_ns if os.path.exists(path) else None)
+    if all(mtime is None for mtime in mtimes):
+        return None
+    return tuple(mtimes)
+
+class ParameterCache:
+    # Keeps every league's parameters in memory and reloads a league when its parameter files change on disk
+
+    def __init__(self, data_dir='data', check_interval=1.0):
+        self.data_dir = data_dir
+        self.check_interval = check_interval
+        self.params = {}
+        self.mtimes = {}
+        self.last_check = 0
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        with self.lock:
+            for league in LEAGUES:
+                mtimes = league_mtimes(self.data_dir, league)
+                if mtimes is None:
+                    continue
+                if self.mtimes.get(league) != mtimes:
+                    self.params[league] = load_parameters(league, self.data_dir)
+                    self.mtimes[league] = mtimes
+                    print(f"Loaded parameters for {league}")
+            self.last_check = time.monotonic()
+
+    def get(self, league):
+        # Only stat the files every check_interval seconds so requests stay cheap
+        if time.monotonic() - self.last_check > self.check_interval:
+            self.reload()
+        return self.params[league]
+
+def price_match(params, home_team, away_team, over_under=2.5, max_goals=8):
+    prob_array = fixture_probability_array(home_team, away_team, params, max_goals)
+    odds = {
+        'home_team': home_team,
+        'away_team': away_team,
+        'match_odds': match_odds(prob_array),
+        'over_under': {'line': over_under, 'odds': over_under_odds(prob_array, over_under)},
+        'both_to_score': both_to_score(prob_array),
+        'result_both_to_score': result_both_to_score(prob_array)
+    }
+    return odds
+
+class OddsRequestHandler(BaseHTTPRequestHandler):
+    cache = None
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/odds':
+            self.send_json(404, {'error': 'Unknown path'})
+            return
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        try:
+            max_goals = int(query.get('max_goals', 8))
+            if max_goals < 1:
+                raise ValueError(f'max_goals must be at least 1, got {max_goals}')
+            params = self.cache.get(query['league'])
+            odds = price_match(params, query['home_team'], query['away_team'],
+                               float(query.get('over_under', 2.5)), max_goals)
+        except KeyError as e:
+            self.send_json(404, {'error': f'Not found: {e}'})
+            return
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            # Always answer the client, instead of closing the connection without a response
+            traceback.print_exc()
+            self.send_json(500, {'error': f'Internal error: {e}'})
+            return
+        self.send_json(200, odds)
+
+    def log_message(self, format, *args):
+        return
+
+def make_server(host='127.0.0.1', port=8000, data_dir='data'):
+    handler = type('Handler', (OddsRequestHandler,), {'cache': ParameterCache(data_dir)})
+    return ThreadingHTTPServer((host, port), handler)
+
+def request_odds(league, home_team, away_team, over_under=2.5, host='127.0.0.1', port=8000):
+    # Minimal client for a running service
+    query = urlencode({'league': league, 'home_team': home_team, 'away_team': away_team, 'over_under': over_under})
+    try:
+        with urlopen(f'http://{host}:{port}/odds?{query}') as response:
+            return json.loads(response.read())
+    except HTTPError as e:
+        return json.loads(e.read())
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Serve betting odds from parameters kept in memory")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--data_dir', type=str, default='data', help='Directory containing the data_<league> folders')
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.data_dir)
+    print(f"Serving odds on http://{args.host}:{args.port}/odds")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
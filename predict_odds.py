@@ -1,6 +1,8 @@
 import numpy as np
-import pandas as pd
 import math
+import csv
+import struct
+from functools import lru_cache
 import argparse
 import os
 
@@ -24,108 +26,310 @@ def score_probability(x, y, home_attack, home_defence, away_attack, away_defence
     poisson_y = (mil**y * np.exp(-mil))/math.factorial(y)
     return t*poisson_x*poisson_y    
 
-def get_probability_array(home_team, away_team, df_attack, df_defence, df_home_advantage):
-    prob_array = np.zeros((9,9))
-    total_probability = 0
-    home_attack = df_attack.loc[home_team].attacking_score
-    away_attack = df_attack.loc[away_team].attacking_score
-    home_defence = df_defence.loc[home_team].defending_score
-    away_defence = df_defence.loc[away_team].defending_score
-    home_advantage = df_home_advantage.loc['home_advantage'].value
-    p = df_home_advantage.loc['p'].value
-
-    # Get probability of each scoreline up to 8 goals
-    for i in range(9):
-        for j in range(9):
-            prob = score_probability(i, j, home_attack, home_defence, away_attack, away_defence, home_advantage, p)
-            prob_array[i][j] = prob
-            total_probability += prob
-            
-    prob_array /= total_probability # Normalise probabilities
-    return prob_array
+def check_max_goals(max_goals):
+    # The Dixon-Coles correction needs the 0 and 1 goal rows and columns of the grid
+    if max_goals < 1:
+        raise ValueError(f'max_goals must be at least 1, got {max_goals}')
+
+def max_goals_argument(value):
+    # argparse type for --max_goals
+    max_goals = int(value)
+    if max_goals < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, got {max_goals}')
+    return max_goals
+
+def poisson_pmf_batch(rates, max_goals):
+    # Poisson probabilities of 0 to max_goals goals for every rate, one row per rate, built with a
+    # cumulative product instead of factorials
+    pmf = np.empty((len(rates), max_goals + 1))
+    pmf[:, 0] = 1
+    pmf[:, 1:] = rates[:, None] / np.arange(1, max_goals + 1)
+    return np.exp(-rates)[:, None] * np.cumprod(pmf, axis=1)
+
+def scoreline_grids(lambd, mil, p, max_goals=8):
+    # Scoreline grids for arrays of expected home and away goals, as an (n_matches, max_goals+1, max_goals+1)
+    # array; scoreline_matrix and price_fixtures both build their grids here
+    check_max_goals(max_goals)
+    # Independent Poisson grids, with the Dixon-Coles correction only affecting the 2x2 corner
+    prob_tensor = poisson_pmf_batch(lambd, max_goals)[:, :, None] * poisson_pmf_batch(mil, max_goals)[:, None, :]
+    prob_tensor[:, 0, 0] *= 1 - lambd*mil*p
+    prob_tensor[:, 0, 1] *= 1 + lambd*p
+    prob_tensor[:, 1, 0] *= 1 + mil*p
+    prob_tensor[:, 1, 1] *= 1 - p
+
+    prob_tensor /= prob_tensor.sum(axis=(1, 2))[:, None, None] # Normalise probabilities
+    return prob_tensor
+
+def scoreline_matrix(home_attack, home_defence, away_attack, away_defence, home_advantage, p, max_goals=8):
+    # The grid of a single match, as a batch of one
+    lambd = np.array([home_attack * away_defence * home_advantage], dtype=float)
+    mil = np.array([away_attack * home_defence], dtype=float)
+    return scoreline_grids(lambd, mil, p, max_goals)[0]
+
+def get_probability_array(home_team, away_team, df_attack, df_defence, df_home_advantage, max_goals=8):
+    home_attack = df_attack.at[home_team, 'attacking_score']
+    away_attack = df_attack.at[away_team, 'attacking_score']
+    home_defence = df_defence.at[home_team, 'defending_score']
+    away_defence = df_defence.at[away_team, 'defending_score']
+    home_advantage = df_home_advantage.at['home_advantage', 'value']
+    p = df_home_advantage.at['p', 'value']
+
+    # Get probability of each scoreline up to max_goals goals
+    return scoreline_matrix(home_attack, home_defence, away_attack, away_defence, home_advantage, p, max_goals)
+
+# Binary parameter file: a header, the '\n'-separated team names padded to 8 bytes, then a float64 array of
+# attacking scores, defending scores, home advantage and p, so the array can be memory-mapped in place
+PARAMETER_FILE_MAGIC = b'ADSP'
+PARAMETER_FILE_VERSION = 1
+PARAMETER_FILE_HEADER = struct.Struct('<4sIII')
+
+def write_parameter_file(path, teams, parameters):
+    names = '\n'.join(teams).encode('utf-8')
+    padding = -(PARAMETER_FILE_HEADER.size + len(names)) % 8
+    values = np.ascontiguousarray(parameters, dtype='<f8')
+    if len(values) != 2 * len(teams) + 2:
+        raise ValueError('Expected attacking and defending scores for every team plus home advantage and p')
+    with open(path, 'wb') as file:
+        file.write(PARAMETER_FILE_HEADER.pack(PARAMETER_FILE_MAGIC, PARAMETER_FILE_VERSION, len(teams), len(names)))
+        file.write(names + b'\0' * padding)
+        file.write(values.tobytes())
+
+def load_parameter_file(path, mmap=False):
+    with open(path, 'rb') as file:
+        magic, version, num_teams, names_length = PARAMETER_FILE_HEADER.unpack(file.read(PARAMETER_FILE_HEADER.size))
+        if magic != PARAMETER_FILE_MAGIC or version != PARAMETER_FILE_VERSION:
+            raise ValueError(f'{path} is not a version {PARAMETER_FILE_VERSION} parameter file')
+        teams = file.read(names_length).decode('utf-8').split('\n')
+        offset = PARAMETER_FILE_HEADER.size + names_length + (-(PARAMETER_FILE_HEADER.size + names_length) % 8)
+        if mmap:
+            values = np.memmap(path, dtype='<f8', mode='r', offset=offset, shape=(2 * num_teams + 2,))
+        else:
+            file.seek(offset)
+            values = np.frombuffer(file.read(), dtype='<f8', count=2 * num_teams + 2)
+    params = {
+        'teams': np.array(teams),
+        'team_index': {team: i for i, team in enumerate(teams)},
+        'attack': values[0:num_teams],
+        'defence': values[num_teams:num_teams*2],
+        'home_advantage': float(values[-2]),
+        'p': float(values[-1])
+    }
+    return params
+
+def variant_file_name(file_name, variant=None):
+    # Parameters of a model variant are saved alongside the goal-based ones, e.g. parameters_xg.bin
+    if variant is None:
+        return file_name
+    base, extension = os.path.splitext(file_name)
+    return f'{base}_{variant}{extension}'
+
+def load_parameters(league, data_dir='data', variant=None):
+    # Prefer the binary parameter file, falling back to the CSV files
+    league_dir = os.path.join(data_dir, 'data_'+league)
+    parameter_file_path = os.path.join(league_dir, variant_file_name('parameters.bin', variant))
+    if os.path.exists(parameter_file_path):
+        return load_parameter_file(parameter_file_path)
+    return read_parameter_csvs(league_dir, variant)
+
+def read_csv_column(path, key, value):
+    with open(path, newline='') as file:
+        return {row[key]: float(row[value]) for row in csv.DictReader(file)}
+
+def read_parameter_csvs(league_dir, variant=None):
+    # Read the three CSV files with the standard library, so pandas is not needed to price a match
+    attacking_scores = read_csv_column(os.path.join(league_dir, variant_file_name('attacking_scores.csv', variant)), 'team', 'attacking_score')
+    defending_scores = read_csv_column(os.path.join(league_dir, variant_file_name('defending_scores.csv', variant)), 'team', 'defending_score')
+    home_advantage = read_csv_column(os.path.join(league_dir, variant_file_name('home_advantage.csv', variant)), 'parameter', 'value')
+    teams = list(attacking_scores)
+    params = {
+        'teams': np.array(teams),
+        'team_index': {team: i for i, team in enumerate(teams)},
+        'attack': np.array([attacking_scores[team] for team in teams]),
+        'defence': np.array([defending_scores[team] for team in teams]),
+        'home_advantage': home_advantage['home_advantage'],
+        'p': home_advantage['p']
+    }
+    return params
+
+def fixture_probability_array(home_team, away_team, params, max_goals=8):
+    home_index = params['team_index'][home_team]
+    away_index = params['team_index'][away_team]
+    return scoreline_matrix(params['attack'][home_index], params['defence'][home_index],
+                            params['attack'][away_index], params['defence'][away_index],
+                            params['home_advantage'], params['p'], max_goals)
+
+def price_fixtures(home_teams, away_teams, params, max_goals=8):
+    # Scoreline grids for many fixtures at once, returned as an (n_matches, max_goals+1, max_goals+1) array
+    home_index = np.array([params['team_index'][team] for team in home_teams], dtype=int)
+    away_index = np.array([params['team_index'][team] for team in away_teams], dtype=int)
+    lambd = params['attack'][home_index] * params['defence'][away_index] * params['home_advantage']
+    mil = params['attack'][away_index] * params['defence'][home_index]
+    return scoreline_grids(lambd, mil, params['p'], max_goals)
+
+def sample_goals(prob_tensor, num_paths, rng, guide_size=256):
+    # Draw a scoreline for every match in every path by inverting the cumulative distribution of each grid
+    num_matches, size, _ = prob_tensor.shape
+    flat = prob_tensor.reshape(num_matches, -1)
+    cumulative = np.cumsum(flat, axis=1)
+    cumulative /= cumulative[:, -1:]
+    # Offsetting each match by its index keeps the concatenated cumulative distributions increasing
+    offsets = np.arange(num_matches)
+    concatenated = (cumulative + offsets[:, None]).ravel()
+    uniform = rng.random((num_paths, num_matches))
+    draws = uniform + offsets
+
+    # A guide table of where each 1/guide_size step of every distribution starts, so each draw only needs
+    # a short forward search from its step instead of a binary search over every scoreline of every match
+    steps = np.arange(guide_size) / guide_size
+    guide = np.searchsorted(concatenated, (offsets[:, None] + steps).ravel())
+    index = guide[offsets * guide_size + (uniform * guide_size).astype(int)].ravel()
+    draws = draws.ravel()
+    remaining = np.flatnonzero(concatenated[index] < draws)
+    while remaining.size:
+        index[remaining] += 1
+        remaining = remaining[concatenated[index[remaining]] < draws[remaining]]
+
+    scoreline = index.reshape(num_paths, num_matches) - offsets * size * size
+    scoreline = np.minimum(scoreline, size * size - 1)
+    return scoreline // size, scoreline % size
+
+# Masks over the flattened scoreline grid, built once per grid size and market line.
+# Each row selects the scorelines that win one outcome of the market.
+
+@lru_cache(maxsize=None)
+def result_masks(size):
+    ones = np.ones((size, size))
+    return np.stack([np.tril(ones, -1).ravel(), np.eye(size).ravel(), np.triu(ones, 1).ravel()])
+
+@lru_cache(maxsize=None)
+def over_under_masks(size, goals):
+    total_goals = np.add.outer(np.arange(size), np.arange(size)).ravel()
+    over = (total_goals > goals).astype(float)
+    return np.stack([over, 1 - over])
+
+@lru_cache(maxsize=None)
+def both_to_score_masks(size):
+    both_score = np.ones((size, size))
+    both_score[0, :] = 0
+    both_score[:, 0] = 0
+    both_score = both_score.ravel()
+    return np.stack([both_score, 1 - both_score])
+
+@lru_cache(maxsize=None)
+def result_both_to_score_masks(size):
+    home_win, draw, away_win = result_masks(size)
+    both_score, not_both_score = both_to_score_masks(size)
+    return np.stack([home_win*both_score, home_win*not_both_score, draw*both_score,
+                     draw*not_both_score, away_win*both_score, away_win*not_both_score])
+
+def market_probabilities(prob_array, masks):
+    # Works on a single grid or a batch of grids; market outcomes along the last axis
+    flat = prob_array.reshape(*prob_array.shape[:-2], -1)
+    return flat @ masks.T
+
+def market_odds(prob_array, masks):
+    # Returns one entry per market outcome
+    odds = np.round(1/market_probabilities(prob_array, masks), 2)
+    return list(np.moveaxis(odds, -1, 0))
 
 def match_odds(prob_array):
-    home_win = 0
-    draw = 0
-    away_win = 0
-    rows, cols = prob_array.shape
-    for i in range(rows):
-        for j in range(cols):
-            if i > j:
-                home_win += prob_array[i][j]
-            elif j > i:
-                away_win += prob_array[i][j]
-            else: 
-                draw += prob_array[i][j]
-    home_win_odds = np.round(1/home_win,2)
-    draw_odds = np.round(1/draw,2)
-    away_win_odds = np.round(1/away_win,2)
-    return [home_win_odds, draw_odds, away_win_odds]
+    return market_odds(prob_array, result_masks(prob_array.shape[-1]))
 
 def score_odds(prob_array):
+    import pandas as pd
     return pd.DataFrame(np.round(1/prob_array,2))
 
+def format_table(columns, index=None):
+    # Right-aligned plain text table, used by the CLI instead of printing DataFrames
+    headers = [str(header) for header in columns]
+    cells = [[f'{value:.2f}' if isinstance(value, float) else str(value) for value in values] for values in columns.values()]
+    if index is not None:
+        headers = [''] + headers
+        cells = [[str(value) for value in index]] + cells
+    widths = [max([len(header)] + [len(cell) for cell in column]) for header, column in zip(headers, cells)]
+    lines = ['  '.join(header.rjust(width) for header, width in zip(headers, widths))]
+    for row in zip(*cells):
+        lines.append('  '.join(cell.rjust(width) for cell, width in zip(row, widths)))
+    return '\n'.join(lines)
+
+def format_score_odds(prob_array):
+    odds = np.round(1/prob_array,2)
+    return format_table({j: [float(value) for value in odds[:, j]] for j in range(odds.shape[1])}, index=range(odds.shape[0]))
+
 def over_under_odds(prob_array, goals):
-    over = 0
-    under = 0
-    rows, cols = prob_array.shape
-    for i in range(rows):
-        for j in range(cols):
-            if i+j > goals:
-                over += prob_array[i][j]
-            else:
-                under += prob_array[i][j]
-    over_odds = np.round(1/over,2)
-    under_odds = np.round(1/under,2)
-    return [over_odds, under_odds]
+    return market_odds(prob_array, over_under_masks(prob_array.shape[-1], goals))
 
 def both_to_score(prob_array):
-    both_score = 0
-    not_both_score = 0
-    rows, cols = prob_array.shape
-    for i in range(rows):
-        for j in range(cols):
-            if i == 0 or j == 0:
-                not_both_score += prob_array[i][j]
-            else: 
-                both_score += prob_array[i][j]
-    both_score_odds = np.round(1/both_score,2)
-    not_both_score_odds = np.round(1/not_both_score,2)
-    return [both_score_odds, not_both_score_odds]
+    return market_odds(prob_array, both_to_score_masks(prob_array.shape[-1]))
 
 def result_both_to_score(prob_array):
-    home_win_both_score = 0
-    home_win_not_both_score = 0
-    draw_both_score = 0
-    draw_not_both_score = 0
-    away_win_both_score = 0
-    away_win_not_both_score = 0
-    rows, cols = prob_array.shape
-    for i in range(rows):
-        for j in range(cols):
-            if i > j:
-                if j == 0:
-                    home_win_not_both_score += prob_array[i][j]
-                else:
-                    home_win_both_score += prob_array[i][j]
-            elif j > i:
-                if i == 0:
-                    away_win_not_both_score += prob_array[i][j]
-                else: 
-                    away_win_both_score += prob_array[i][j]
-            else:
-                if j == 0:
-                    draw_not_both_score += prob_array[i][j]
-                else:
-                    draw_both_score += prob_array[i][j]
-    home_win_both_score_odds = np.round(1/home_win_both_score,2)
-    home_win_not_both_score_odds = np.round(1/home_win_not_both_score,2)
-    draw_both_score_odds = np.round(1/draw_both_score,2)
-    draw_not_both_score_odds = np.round(1/draw_not_both_score,2)
-    away_win_both_score_odds = np.round(1/away_win_both_score,2)
-    away_win_not_both_score_odds = np.round(1/away_win_not_both_score,2)
-    return [home_win_both_score_odds, home_win_not_both_score_odds, draw_both_score_odds, 
-            draw_not_both_score_odds, away_win_both_score_odds, away_win_not_both_score_odds]
+    return market_odds(prob_array, result_both_to_score_masks(prob_array.shape[-1]))
+
+# Total goals and goal difference distributions, read off the anti-diagonals and diagonals of the grid
+
+@lru_cache(maxsize=None)
+def total_goals_indicator(size):
+    total_goals = np.add.outer(np.arange(size), np.arange(size)).ravel()
+    return (total_goals[:, None] == np.arange(2*size - 1)).astype(float)
+
+@lru_cache(maxsize=None)
+def goal_difference_indicator(size):
+    goal_difference = np.subtract.outer(np.arange(size), np.arange(size)).ravel()
+    return (goal_difference[:, None] == np.arange(1 - size, size)).astype(float)
+
+def total_goals_distribution(prob_array):
+    # Probability of 0 to 2*max_goals total goals
+    size = prob_array.shape[-1]
+    return prob_array.reshape(*prob_array.shape[:-2], -1) @ total_goals_indicator(size)
+
+def goal_difference_distribution(prob_array):
+    # Probability of home goals minus away goals from -max_goals to max_goals
+    size = prob_array.shape[-1]
+    return prob_array.reshape(*prob_array.shape[:-2], -1) @ goal_difference_indicator(size)
+
+def asian_line_odds(distribution, values, lines):
+    # Fair odds of being above and below each line; whole lines push on equality and quarter lines
+    # split the stake across the two neighbouring lines, giving half wins and half losses
+    lines = np.asarray(lines, dtype=float)
+    quarter = (lines * 4) % 2 == 1
+    lower_line = np.where(quarter, lines - 0.25, lines)
+    upper_line = np.where(quarter, lines + 0.25, lines)
+    above = (distribution @ (values[:, None] > lower_line).astype(float)
+             + distribution @ (values[:, None] > upper_line).astype(float))
+    below = (distribution @ (values[:, None] < lower_line).astype(float)
+             + distribution @ (values[:, None] < upper_line).astype(float))
+    with np.errstate(divide='ignore'):
+        above_odds = np.round(1 + below/above, 2)
+        below_odds = np.round(1 + above/below, 2)
+    return above_odds, below_odds
+
+def goal_ladders(prob_array, total_lines=None, handicap_lines=None):
+    # Every over/under and Asian handicap line from a single grid (or batch of grids)
+    size = prob_array.shape[-1]
+    if total_lines is None:
+        total_lines = np.arange(0.5, 8.75, 0.25)
+    if handicap_lines is None:
+        handicap_lines = np.arange(-3, 3.25, 0.25)
+    total_lines = np.asarray(total_lines, dtype=float)
+    handicap_lines = np.asarray(handicap_lines, dtype=float)
+
+    total_goals = total_goals_distribution(prob_array)
+    goal_difference = goal_difference_distribution(prob_array)
+    over, under = asian_line_odds(total_goals, np.arange(2*size - 1), total_lines)
+    # A home handicap of h wins when the goal difference is above -h; the away side takes the other half
+    home, away = asian_line_odds(goal_difference, np.arange(1 - size, size), -handicap_lines)
+
+    ladders = {
+        'total_goals': total_goals,
+        'goal_difference': goal_difference,
+        'total_lines': total_lines,
+        'over': over,
+        'under': under,
+        'handicap_lines': handicap_lines,
+        'home': home,
+        'away': away
+    }
+    return ladders
 
 def main():
     # Set up argument parser
@@ -142,7 +346,10 @@ def main():
     parser.add_argument('--over_under', type=float, help='Set over/under value')
     parser.add_argument('--both_to_score', action='store_true', help='Calculate odds of both teams scoring')
     parser.add_argument('--result_both_to_score', action='store_true', help='Calculate result and odds of both teams scoring')
+    parser.add_argument('--ladder', action='store_true', help='Show every over/under and Asian handicap line')
     parser.add_argument('--all', action='store_true', help='Show all calculated odds')
+    parser.add_argument('--max_goals', type=max_goals_argument, default=8, help='Highest number of goals per team in the scoreline grid')
+    parser.add_argument('--variant', type=str, help="Use a model variant's parameters, e.g. 'xg' for the xG-based model")
     
     # Parse the arguments
     args = parser.parse_args()
@@ -152,15 +359,10 @@ def main():
     print(f"Away Team: {args.away_team}")
     print("-------------------------------------------")
     
-     # Read CSV files
-    attacking_scores_csv_path = os.path.join('data', 'data_'+args.league, 'attacking_scores.csv')
-    defending_scores_csv_path = os.path.join('data', 'data_'+args.league, 'defending_scores.csv')
-    home_advantage_csv_path = os.path.join('data', 'data_'+args.league, 'home_advantage.csv')
-    df_attack = pd.read_csv(attacking_scores_csv_path, index_col='team')
-    df_defence = pd.read_csv(defending_scores_csv_path, index_col='team')
-    df_home_advantage = pd.read_csv(home_advantage_csv_path, index_col='parameter')
-
-    prob_array = get_probability_array(args.home_team, args.away_team, df_attack, df_defence, df_home_advantage)
+    # Read parameter files
+    params = load_parameters(args.league, variant=args.variant)
+
+    prob_array = fixture_probability_array(args.home_team, args.away_team, params, args.max_goals)
     
     if args.match_odds:
         home_win, draw, away_win = match_odds(prob_array)
@@ -170,7 +372,7 @@ def main():
     
     if args.score_odds:
         print("Rows represent home team score and columns represent away team score")
-        print(score_odds(prob_array))
+        print(format_score_odds(prob_array))
     
     if args.over_under is not None:
         over, under = over_under_odds(prob_array, args.over_under)
@@ -182,6 +384,14 @@ def main():
         print(f"Both to Score Odds: {both_score}")
         print(f"Not Both to Score Odds: {not_both_score}")
 
+    if args.ladder:
+        ladders = goal_ladders(prob_array)
+        print("Over/Under Odds")
+        print(format_table({'line': ladders['total_lines'].tolist(), 'over': ladders['over'].tolist(), 'under': ladders['under'].tolist()}))
+        print("-------------------------------------------")
+        print(f"Asian Handicap Odds (handicap applied to {args.home_team})")
+        print(format_table({'handicap': ladders['handicap_lines'].tolist(), args.home_team: ladders['home'].tolist(), args.away_team: ladders['away'].tolist()}))
+
     if args.result_both_to_score:
         home_win_both_score, home_win_not_both_score, draw_both_score, draw_not_both_score, away_win_both_score, away_win_not_both_score = result_both_to_score(prob_array)
         print(f"{args.home_team} to win and both to Score Odds: {home_win_both_score}")
@@ -199,7 +409,7 @@ def main():
         print("-------------------------------------------")
 
         print("Rows represent home team score and columns represent away team score")
-        print(score_odds(prob_array))
+        print(format_score_odds(prob_array))
         print("-------------------------------------------")
 
         both_score, not_both_score = both_to_score(prob_array)
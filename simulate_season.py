@@ -0,0 +1,151 @@
+from predict_odds import load_parameters
+from predict_odds import price_fixtures
+from predict_odds import sample_goals
+from predict_odds import max_goals_argument
+from estimate_ad_score import league_url
+from estimate_ad_score import LEAGUE_URL_NAMES
+from understat import fetch_league_data
+import pandas as pd
+import numpy as np
+import argparse
+import time
+
+def split_fixtures(data):
+    # Played results and remaining fixtures of a season's understat match list
+    played = [match for match in data if match['isResult']]
+    remaining = [match for match in data if not match['isResult']]
+    results = {
+        'home_team': np.array([match['h']['title'] for match in played], dtype=str),
+        'away_team': np.array([match['a']['title'] for match in played], dtype=str),
+        'home_goals': np.array([int(match['goals']['h']) for match in played], dtype=int),
+        'away_goals': np.array([int(match['goals']['a']) for match in played], dtype=int)
+    }
+    fixtures = {
+        'home_team': np.array([match['h']['title'] for match in remaining], dtype=str),
+        'away_team': np.array([match['a']['title'] for match in remaining], dtype=str)
+    }
+    return results, fixtures
+
+def table_totals(home_index, away_index, home_goals, away_goals, num_teams):
+    # Points, goal difference and goals scored of every team, for one set of results or a batch of simulated
+    # seasons (goals shaped (num_seasons, num_matches)), accumulated by multiplying with match-team incidence
+    home = np.zeros((home_index.size, num_teams), dtype=np.float32)
+    home[np.arange(home_index.size), home_index] = 1
+    away = np.zeros((away_index.size, num_teams), dtype=np.float32)
+    away[np.arange(away_index.size), away_index] = 1
+    home_points = 3*(home_goals > away_goals) + (home_goals == away_goals)
+    away_points = 3*(away_goals > home_goals) + (home_goals == away_goals)
+    points = home_points.astype(np.float32) @ home + away_points.astype(np.float32) @ away
+    goal_difference = (home_goals - away_goals).astype(np.float32) @ (home - away)
+    goals_scored = home_goals.astype(np.float32) @ home + away_goals.astype(np.float32) @ away
+    return points, goal_difference, goals_scored
+
+def simulate_season(results, fixtures, params, num_seasons=100000, max_goals=8, seed=None, chunk_size=10000):
+    # Final points and position of every team in each simulated season, with the remaining fixtures drawn
+    # from the model's scoreline grids. Ties are broken on goal difference, then goals scored, then at random.
+    teams = np.union1d(np.union1d(results['home_team'], results['away_team']),
+                       np.union1d(fixtures['home_team'], fixtures['away_team']))
+    unknown = [team for team in teams if team not in params['team_index']]
+    if unknown:
+        raise Exception(f'No parameters for {", ".join(unknown)}; fit the season with them, e.g. with --season including it')
+    num_teams = len(teams)
+    rng = np.random.default_rng(seed)
+
+    # Table so far
+    points, goal_difference, goals_scored = table_totals(
+        np.searchsorted(teams, results['home_team']), np.searchsorted(teams, results['away_team']),
+        results['home_goals'], results['away_goals'], num_teams)
+
+    home_index = np.searchsorted(teams, fixtures['home_team'])
+    away_index = np.searchsorted(teams, fixtures['away_team'])
+    prob_tensor = price_fixtures(fixtures['home_team'], fixtures['away_team'], params, max_goals)
+
+    final_points = np.empty((num_seasons, num_teams), dtype=np.float32)
+    positions = np.empty((num_seasons, num_teams), dtype=np.int8)
+    for start in range(0, num_seasons, chunk_size):
+        size = min(chunk_size, num_seasons - start)
+        if len(prob_tensor) > 0:
+            home_goals, away_goals = sample_goals(prob_tensor, size, rng)
+        else:
+            home_goals = away_goals = np.zeros((size, 0), dtype=int)
+        simulated = table_totals(home_index, away_index, home_goals, away_goals, num_teams)
+        season_points, season_goal_difference, season_goals_scored = (total + current for total, current in
+                                                                      zip(simulated, (points, goal_difference, goals_scored)))
+        # One sort key holding every tie-breaker; goal difference and goals scored stay below 1000
+        key = (season_points.astype(np.float64)*1000 + season_goal_difference + 500)*1000 + season_goals_scored + rng.random((size, num_teams))
+        order = np.argsort(-key, axis=1)
+        np.put_along_axis(positions[start:start+size], order, np.arange(num_teams, dtype=np.int8)[None, :].repeat(size, axis=0), axis=1)
+        final_points[start:start+size] = season_points
+    return teams, final_points, positions
+
+def season_summary(teams, final_points, positions, top=4, relegated=3):
+    # Expected points, title, top and relegation probabilities, and the distribution of final positions
+    num_seasons, num_teams = positions.shape
+    distribution = np.zeros((num_teams, num_teams))
+    for team in range(num_teams):
+        distribution[team] = np.bincount(positions[:, team], minlength=num_teams) / num_seasons
+    summary = pd.DataFrame({
+        'expected_points': final_points.mean(axis=0, dtype=np.float64),
+        'title': distribution[:, 0],
+        f'top_{top}': distribution[:, :top].sum(axis=1),
+        'relegation': distribution[:, num_teams-relegated:].sum(axis=1),
+        'expected_position': distribution @ np.arange(1, num_teams + 1)
+    }, index=pd.Index(teams, name='team'))
+    positions = pd.DataFrame(distribution, index=summary.index, columns=np.arange(1, num_teams + 1))
+    order = summary['expected_points'].sort_values(ascending=False).index
+    return summary.loc[order], positions.loc[order]
+
+def simulate_league(league, season=2024, num_seasons=100000, max_goals=8, seed=None, offline=False, variant=None,
+                    data_dir='data', top=4, relegated=3):
+    start_time = time.perf_counter()
+    results, fixtures = split_fixtures(fetch_league_data(league_url(league, season), offline))
+    params = load_parameters(league, data_dir, variant)
+    teams, final_points, positions = simulate_season(results, fixtures, params, num_seasons, max_goals, seed)
+    summary, distribution = season_summary(teams, final_points, positions, top, relegated)
+    return summary, distribution, len(fixtures['home_team']), time.perf_counter() - start_time
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Simulate the rest of a season for outright market probabilities")
+    parser.add_argument('leagues', type=str, nargs='*', help='Leagues to simulate (default: all five)')
+    parser.add_argument('--season', type=int, default=2024, help='Season to simulate, by the year it starts in')
+    parser.add_argument('--simulations', type=int, default=100000, help='Number of simulated seasons')
+    parser.add_argument('--max_goals', type=max_goals_argument, default=8, help='Highest number of goals per team in the scoreline grid')
+    parser.add_argument('--top', type=int, default=4, help='Number of places counted as the top (e.g. Champions League places)')
+    parser.add_argument('--relegated', type=int, default=3, help='Number of relegation places')
+    parser.add_argument('--seed', type=int, help='Random seed, for reproducible simulations')
+    parser.add_argument('--variant', type=str, help="Use a model variant's parameters, e.g. 'xg' for the xG-based model")
+    parser.add_argument('--offline', action='store_true', help='Use the saved snapshots of understat pages instead of the network')
+    parser.add_argument('--positions', action='store_true', help='Also show the distribution of final positions')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes simulating leagues in parallel')
+    parser.add_argument('--output', type=str, help='Save the summary of every league to this CSV file')
+    args = parser.parse_args()
+
+    leagues = args.leagues or list(LEAGUE_URL_NAMES)
+    # Independent random streams for every league, whichever process simulates it
+    seeds = np.random.SeedSequence(args.seed).spawn(len(leagues))
+    options = dict(season=args.season, num_seasons=args.simulations, max_goals=args.max_goals, offline=args.offline,
+                   variant=args.variant, top=args.top, relegated=args.relegated)
+    if args.workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(simulate_league, league, seed=seed, **options) for league, seed in zip(leagues, seeds)]
+            simulations = [future.result() for future in futures]
+    else:
+        simulations = [simulate_league(league, seed=seed, **options) for league, seed in zip(leagues, seeds)]
+
+    summaries = []
+    for league, (summary, distribution, num_fixtures, wall_time) in zip(leagues, simulations):
+        print("-------------------------------------------")
+        print(f'{league} {args.season}: {args.simulations} seasons of {num_fixtures} remaining fixtures in {wall_time:.2f}s')
+        print(summary.round(3).to_string())
+        if args.positions:
+            print(distribution.round(3).to_string())
+        summaries.append(summary.assign(league=league))
+    if args.output is not None:
+        pd.concat(summaries).to_csv(args.output)
+        print(f'Summary saved as {args.output}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+from test_model import load_betting_odds
+from test_model import add_odds_to_df
+from test_model import backtest
+from predict_odds import load_parameters
+from predict_odds import max_goals_argument
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import itertools
+import argparse
+import time
+import os
+
+# Market groups that can be named on the command line, besides single markets such as 'H' or 'Over2.5'
+MARKET_GROUPS = {
+    'result': ('H', 'D', 'A'),
+    'over_under': ('Over2.5', 'Under2.5'),
+    'all': ('H', 'D', 'A', 'Over2.5', 'Under2.5')
+}
+
+# Odds data and parameters shared by every backtest in a worker, set once when the worker starts
+shared = {}
+
+def init_worker(df, params, wallet):
+    shared['df'] = df
+    shared['params'] = params
+    shared['wallet'] = wallet
+    shared['priced'] = {}
+
+def run_backtest(config):
+    # Predicted odds only depend on the parameters and grid size, so they are reused across staking settings
+    key = (config['parameters'], config['max_goals'])
+    if key not in shared['priced']:
+        shared['priced'][key] = add_odds_to_df(shared['df'].copy(), shared['params'][config['parameters']], config['max_goals'])
+    markets = MARKET_GROUPS.get(config['market'], (config['market'],))
+    ledger, summary = backtest(shared['priced'][key], shared['wallet'], markets,
+                               config['kelly_fraction'], config['edge_threshold'], config['bookmaker'])
+    total = summary.loc['Total']
+    return {**config, 'bets': int(total['bets']), 'staked': total['staked'], 'profit': total['profit'], 'roi': total['roi']}
+
+def sweep(df, params, wallet, grid, workers=None):
+    # Run a backtest for every combination of settings in grid, spread over a process pool
+    keys = list(grid)
+    configs = [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(df, params, wallet)) as executor:
+        results = list(executor.map(run_backtest, configs, chunksize=max(1, len(configs) // (4 * (workers or os.cpu_count())))))
+    return pd.DataFrame(results)
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description="Backtest every combination of strategy settings in parallel")
+    parser.add_argument('league', type=str, help='Specify which league')
+    parser.add_argument('season', type=str, help='Specify which season')
+    parser.add_argument('wallet', type=float, help='Specify how much in your wallet')
+    parser.add_argument('--kelly_fraction', type=float, nargs='+', default=[1], help='Fractions of the Kelly stake to try')
+    parser.add_argument('--edge_threshold', type=float, nargs='+', default=[0], help='Minimum edges over the predicted odds to try')
+    parser.add_argument('--market', type=str, nargs='+', default=['result', 'over_under'], help='Markets or market groups (result/over_under/all) to try')
+    parser.add_argument('--bookmaker', type=str, nargs='+', default=['B365'], help="Bookmakers to bet with, or 'Best' for the best price")
+    parser.add_argument('--max_goals', type=max_goals_argument, nargs='+', default=[8], help='Scoreline grid sizes to try')
+    parser.add_argument('--parameter_dirs', type=str, nargs='+', default=['./data'],
+                        help='Directories holding data_<league> parameters, e.g. fitted on different training windows')
+    parser.add_argument('--workers', type=int, help='Number of worker processes')
+    parser.add_argument('--output', type=str, default='sweep_results.csv', help='CSV file to save the results table to')
+    args = parser.parse_args()
+
+    # Read the odds and every parameter set once; workers receive them when they start
+    params = {data_dir: load_parameters(args.league, data_dir) for data_dir in args.parameter_dirs}
+    # Only matches every parameter set can price
+    teams = set.intersection(*(set(p['teams']) for p in params.values()))
+    df = load_betting_odds(args.league, args.season, list(teams))
+    grid = {
+        'parameters': args.parameter_dirs,
+        'max_goals': args.max_goals,
+        'market': args.market,
+        'bookmaker': args.bookmaker,
+        'kelly_fraction': args.kelly_fraction,
+        'edge_threshold': args.edge_threshold
+    }
+
+    start_time = time.perf_counter()
+    results = sweep(df, params, args.wallet, grid, args.workers)
+    print(f'Ran {len(results)} backtests in {time.perf_counter() - start_time:.2f}s')
+    results.to_csv(args.output, index=False)
+    print(f'Results saved as {args.output}')
+    print(results.sort_values('profit', ascending=False).head(10).round(3).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,69 +1,66 @@
-from predict_odds import match_odds 
-from predict_odds import get_probability_array
+from predict_odds import load_parameters
+from predict_odds import price_fixtures
+from predict_odds import sample_goals
+from predict_odds import match_odds
 from predict_odds import over_under_odds
+from predict_odds import market_probabilities
+from predict_odds import result_masks
+from predict_odds import over_under_masks
+from betting_odds import load_odds_file
+from betting_odds import add_best_prices
+from betting_odds import market_columns
+from betting_odds import scan_value
+from betting_odds import BOOKMAKERS
+from betting_odds import MARKET_AGGREGATES
 import pandas as pd
 import numpy as np
 import argparse
 
-def df_epl_24_25(url):
-    # Read CSV, standardise team names, and remove newly promoted teams
-    df = pd.read_csv(url)
-    columns = ['HomeTeam', 'AwayTeam', 'FTHG', 'FTAG', 'FTR', 'B365H', 'B365D', 'B365A', 'B365>2.5', 'B365<2.5']
-    df['HomeTeam'] = df['HomeTeam'].replace('Man United', 'Manchester United')
-    df['AwayTeam'] = df['AwayTeam'].replace('Man United', 'Manchester United')
-    df['HomeTeam'] = df['HomeTeam'].replace('Man City', 'Manchester City')
-    df['AwayTeam'] = df['AwayTeam'].replace('Man City', 'Manchester City')
-    df['HomeTeam'] = df['HomeTeam'].replace("Nott'm Forest", 'Nottingham Forest')
-    df['AwayTeam'] = df['AwayTeam'].replace("Nott'm Forest", 'Nottingham Forest')
-    df['HomeTeam'] = df['HomeTeam'].replace('Wolves', 'Wolverhampton Wanderers')
-    df['AwayTeam'] = df['AwayTeam'].replace('Wolves', 'Wolverhampton Wanderers')
-    df['HomeTeam'] = df['HomeTeam'].replace('Newcastle', 'Newcastle United')
-    df['AwayTeam'] = df['AwayTeam'].replace('Newcastle', 'Newcastle United')
-    df = df[~df['HomeTeam'].isin(['Leicester', 'Southampton', 'Ipswich'])]
-    df = df[~df['AwayTeam'].isin(['Leicester', 'Southampton', 'Ipswich'])]
-    df = df.reset_index(drop=True)
-    df = df[columns]
-    return df
+COLUMNS = ['Date', 'Time', 'HomeTeam', 'AwayTeam', 'FTHG', 'FTAG', 'FTR', 'B365H', 'B365D', 'B365A', 'B365>2.5', 'B365<2.5']
 
-def df_epl_23_24(url):
-    # Read CSV, standardise team names, and remove newly promoted teams
-    df = pd.read_csv(url)
-    columns = ['HomeTeam', 'AwayTeam', 'FTHG', 'FTAG', 'FTR', 'B365H', 'B365D', 'B365A', 'B365>2.5', 'B365<2.5']
-    df['HomeTeam'] = df['HomeTeam'].replace('Man United', 'Manchester United')
-    df['AwayTeam'] = df['AwayTeam'].replace('Man United', 'Manchester United')
-    df['HomeTeam'] = df['HomeTeam'].replace('Man City', 'Manchester City')
-    df['AwayTeam'] = df['AwayTeam'].replace('Man City', 'Manchester City')
-    df['HomeTeam'] = df['HomeTeam'].replace("Nott'm Forest", 'Nottingham Forest')
-    df['AwayTeam'] = df['AwayTeam'].replace("Nott'm Forest", 'Nottingham Forest')
-    df['HomeTeam'] = df['HomeTeam'].replace('Wolves', 'Wolverhampton Wanderers')
-    df['AwayTeam'] = df['AwayTeam'].replace('Wolves', 'Wolverhampton Wanderers')
-    df['HomeTeam'] = df['HomeTeam'].replace('Newcastle', 'Newcastle United')
-    df['AwayTeam'] = df['AwayTeam'].replace('Newcastle', 'Newcastle United')
-    df = df.reset_index(drop=True)
-    df = df[columns]
+def odds_to_df(data, columns=COLUMNS):
+    # Build a DataFrame from the cached columns, with every bookmaker's match and over/under 2.5 odds, the
+    # market maximum and average, and the best price across bookmakers; team names are already standardised
+    data = add_best_prices(data)
+    columns = list(columns)
+    for bookmaker in BOOKMAKERS + MARKET_AGGREGATES + ['Best', 'BestBookmaker']:
+        for market in ['result', 'over_under']:
+            columns += [column for column in market_columns(bookmaker, market) if column in data and column not in columns]
+    df = pd.DataFrame({column: data[column] for column in columns})
+    for column in ['FTHG', 'FTAG']:
+        if column in df:
+            df[column] = df[column].astype(int)
     return df
 
-def add_odds_to_df(df, df_attack, df_defence, df_home_advantage):
-    # Calculate predicted odds for each match
-    predicted_home_odds = []
-    predicted_draw_odds = []
-    predicted_away_odds = []
-    over_2half_odds = []
-    under_2half_odds = []
-    for i in range(len(df)):
-        prob_array = get_probability_array(df['HomeTeam'][i], df['AwayTeam'][i], df_attack, df_defence, df_home_advantage)
-        result_odds = match_odds(prob_array)
-        over_under_2half_odds = over_under_odds(prob_array, 2.5)
-        predicted_home_odds.append(result_odds[0])
-        predicted_draw_odds.append(result_odds[1])
-        predicted_away_odds.append(result_odds[2])
-        over_2half_odds.append(over_under_2half_odds[0])
-        under_2half_odds.append(over_under_2half_odds[1])
-    df['Predicted_H'] = predicted_home_odds
-    df['Predicted_D'] = predicted_draw_odds
-    df['Predicted_A'] = predicted_away_odds
-    df['Predicted_Over2.5'] = over_2half_odds
-    df['Predicted_Under2.5'] = under_2half_odds
+def known_teams(data, teams):
+    # Remove matches involving teams without parameters, e.g. newly promoted teams not in the training data
+    if teams is None:
+        return data
+    known = np.isin(data['HomeTeam'], teams) & np.isin(data['AwayTeam'], teams)
+    return {column: values[known] for column, values in data.items()}
+
+def df_epl_24_25(url, teams=None):
+    # Read CSV (through the column cache) and remove teams that cannot be priced
+    return odds_to_df(known_teams(load_odds_file(url), teams))
+
+def df_epl_23_24(url, teams=None):
+    # Read CSV (through the column cache)
+    return odds_to_df(known_teams(load_odds_file(url), teams))
+
+def load_betting_odds(league, season, teams=None):
+    # Choose league and season
+    if league == 'EPL' and season == "24/25":
+        return df_epl_24_25('./data/betting_odds/EPL_24_25.csv', teams)
+    elif league == 'EPL' and season == "23/24":
+        return df_epl_23_24('./data/betting_odds/EPL_23_24.csv', teams)
+    else: 
+        raise Exception('League and Season not found')
+
+def add_odds_to_df(df, params, max_goals=8):
+    # Calculate predicted odds for every match in one batch
+    prob_tensor = price_fixtures(df['HomeTeam'], df['AwayTeam'], params, max_goals)
+    df['Predicted_H'], df['Predicted_D'], df['Predicted_A'] = match_odds(prob_tensor)
+    df['Predicted_Over2.5'], df['Predicted_Under2.5'] = over_under_odds(prob_tensor, 2.5)
     return df
 
 def kelly_criterion(actual_odds, predicted_odds, wallet):
@@ -72,50 +69,162 @@ def kelly_criterion(actual_odds, predicted_odds, wallet):
     b = actual_odds-1
     return (b*p-q)*wallet/b
 
-def count_winnings_result(df, wallet):
-    winnings = 0
-    for i in range(len(df)):
-        # Bet if actual odds are more than predicted odds
-        if df['B365H'][i] > df['Predicted_H'][i]:
-            # Bet for home win
-            toBet = kelly_criterion(df['B365H'][i], df['Predicted_H'][i], wallet)
-            if df['FTR'][i] == 'H': # Home Win
-                winnings += toBet * (df['B365H'][i] - 1)
-            else:
-                winnings -= toBet
-        if df['B365D'][i] > df['Predicted_D'][i]:
-            # Bet for draw
-            toBet = kelly_criterion(df['B365D'][i], df['Predicted_D'][i], wallet)
-            if df['FTR'][i] == 'D': # Draw
-                winnings += toBet * (df['B365D'][i] - 1)
-            else:
-                winnings -= toBet
-        if df['B365A'][i] > df['Predicted_A'][i]:
-            # Bet for away win
-            toBet = kelly_criterion(df['B365A'][i], df['Predicted_A'][i], wallet)
-            if df['FTR'][i] == 'A': # Draw
-                winnings += toBet * (df['B365A'][i] - 1)
-            else:
-                winnings -= toBet
-    return winnings
-
-def count_winnings_over_under(df, wallet):
-    winnings = 0
-    for i in range(len(df)):
-        # Bet if actual odds are more than predicted odds
-        if df['B365>2.5'][i] > df['Predicted_Over2.5'][i]:
-            toBet = kelly_criterion(df['B365>2.5'][i], df['Predicted_Over2.5'][i], wallet)
-            if df['FTHG'][i] + df['FTHG'][i] > 2.5:
-                winnings += toBet * (df['B365>2.5'][i] - 1)
-            else:
-                winnings -= toBet
-        if df['B365<2.5'][i] > df['Predicted_Under2.5'][i]:
-            toBet = kelly_criterion(df['B365<2.5'][i], df['Predicted_Under2.5'][i], wallet)
-            if df['FTHG'][i] + df['FTHG'][i] < 2.5: 
-                winnings += toBet * (df['B365<2.5'][i] - 1)
-            else:
-                winnings -= toBet
-    return winnings
+# Market name: (betting_odds market, outcome within that market, predicted odds column)
+MARKETS = {
+    'H': ('result', 0, 'Predicted_H'),
+    'D': ('result', 1, 'Predicted_D'),
+    'A': ('result', 2, 'Predicted_A'),
+    'Over2.5': ('over_under', 0, 'Predicted_Over2.5'),
+    'Under2.5': ('over_under', 1, 'Predicted_Under2.5')
+}
+
+def odds_columns(markets, bookmaker='B365'):
+    # Columns holding the bookmaker's odds for each market; 'Best' gives the best price across bookmakers
+    return [market_columns(bookmaker, MARKETS[market][0])[MARKETS[market][1]] for market in markets]
+
+def predicted_columns(markets):
+    return [MARKETS[market][2] for market in markets]
+
+def outcomes_from_goals(home_goals, away_goals, markets):
+    # Whether each market won, with markets along the last axis
+    total_goals = home_goals + away_goals
+    outcomes = {
+        'H': home_goals > away_goals,
+        'D': home_goals == away_goals,
+        'A': home_goals < away_goals,
+        'Over2.5': total_goals > 2.5,
+        'Under2.5': total_goals < 2.5
+    }
+    return np.stack([outcomes[market] for market in markets], axis=-1)
+
+def market_outcomes(df, markets):
+    # Whether each market won, one row per match and one column per market
+    return outcomes_from_goals(df['FTHG'].to_numpy(), df['FTAG'].to_numpy(), markets)
+
+def backtest(df, wallet, markets=tuple(MARKETS), kelly_fraction=1, edge_threshold=0, bookmaker='B365'):
+    # Value detection, Kelly staking and settlement for every match and market at once
+    markets = list(markets)
+    actual_odds = df[odds_columns(markets, bookmaker)].to_numpy(dtype=float)
+    predicted_odds = df[predicted_columns(markets)].to_numpy(dtype=float)
+    won = market_outcomes(df, markets)
+
+    # Bet if actual odds are more than predicted odds (by more than edge_threshold)
+    with np.errstate(invalid='ignore'):
+        bet = actual_odds > predicted_odds * (1 + edge_threshold)
+    match_index, market_index = np.nonzero(bet)
+    odds = actual_odds[match_index, market_index]
+    stake = kelly_fraction * kelly_criterion(odds, predicted_odds[match_index, market_index], wallet)
+    bet_won = won[match_index, market_index]
+    profit = np.where(bet_won, stake * (odds - 1), -stake)
+    if bookmaker == 'Best':
+        bet_bookmaker = df[odds_columns(markets, 'BestBookmaker')].to_numpy()[match_index, market_index]
+    else:
+        bet_bookmaker = np.full(len(match_index), bookmaker)
+
+    ledger = pd.DataFrame({
+        'match': match_index,
+        'HomeTeam': df['HomeTeam'].to_numpy()[match_index],
+        'AwayTeam': df['AwayTeam'].to_numpy()[match_index],
+        'market': np.array(markets)[market_index],
+        'bookmaker': bet_bookmaker,
+        'odds': odds,
+        'predicted_odds': predicted_odds[match_index, market_index],
+        'stake': stake,
+        'won': bet_won,
+        'profit': profit
+    })
+    summary = ledger.groupby('market', sort=False).agg(
+        bets=('stake', 'size'), staked=('stake', 'sum'), wins=('won', 'sum'), profit=('profit', 'sum'))
+    summary = summary.reindex(markets, fill_value=0)
+    summary.loc['Total'] = summary.sum()
+    summary = summary.astype({'bets': int, 'wins': int})
+    summary['roi'] = summary['profit'] / summary['staked']
+    return ledger, summary
+
+def count_winnings_result(df, wallet, bookmaker='B365'):
+    ledger, summary = backtest(df, wallet, ['H', 'D', 'A'], bookmaker=bookmaker)
+    return ledger['profit'].sum()
+
+def count_winnings_over_under(df, wallet, bookmaker='B365'):
+    ledger, summary = backtest(df, wallet, ['Over2.5', 'Under2.5'], bookmaker=bookmaker)
+    return ledger['profit'].sum()
+
+def add_matchdays(df):
+    # Sort fixtures chronologically and number the days they are played on; fixtures on the same day
+    # are treated as concurrent, so the bankroll only changes between days
+    df['Kickoff'] = pd.to_datetime(df['Date'] + ' ' + df['Time'], format='%d/%m/%Y %H:%M')
+    df = df.sort_values('Kickoff', kind='stable').reset_index(drop=True)
+    df['Matchday'] = np.unique(df['Kickoff'].dt.normalize(), return_inverse=True)[1]
+    return df
+
+def bet_fractions(df, markets=tuple(MARKETS), kelly_fraction=0.25, max_bet_fraction=0.05, max_exposure=0.2, edge_threshold=0,
+                  bookmaker='B365'):
+    # Fraction of the bankroll staked on each match and market, one row per match
+    markets = list(markets)
+    actual_odds = df[odds_columns(markets, bookmaker)].to_numpy(dtype=float)
+    predicted_odds = df[predicted_columns(markets)].to_numpy(dtype=float)
+    with np.errstate(invalid='ignore'):
+        bet = actual_odds > predicted_odds * (1 + edge_threshold)
+        fractions = np.where(bet, kelly_fraction * kelly_criterion(actual_odds, predicted_odds, 1), 0)
+    fractions = np.clip(np.nan_to_num(fractions), 0, max_bet_fraction)
+
+    # Scale down every bet on a day whose total stake would exceed max_exposure
+    matchday = df['Matchday'].to_numpy()
+    exposure = np.bincount(matchday, weights=fractions.sum(axis=1))
+    scale = np.minimum(1, max_exposure / np.maximum(exposure, 1e-12))
+    return fractions * scale[matchday][:, None]
+
+def simulate_bankroll(df, fractions, won, wallet, markets=tuple(MARKETS), ruin_level=0.1, bookmaker='B365'):
+    # Bankroll at the end of each matchday; won can hold many outcome paths, shaped (..., n_matches, n_markets)
+    markets = list(markets)
+    actual_odds = np.nan_to_num(df[odds_columns(markets, bookmaker)].to_numpy(dtype=float), nan=1)
+    matchday = df['Matchday'].to_numpy()
+    num_matchdays = matchday.max() + 1
+
+    # Stakes are fractions of the bankroll at the start of the day, so each day multiplies the bankroll
+    returns = (fractions * np.where(won, actual_odds - 1, -1)).sum(axis=-1)
+    matchday_indicator = (matchday[:, None] == np.arange(num_matchdays)).astype(float)
+    growth = 1 + returns @ matchday_indicator
+    bankroll = wallet * np.cumprod(growth, axis=-1)
+
+    # Once the bankroll drops below ruin_level of the wallet, betting stops
+    ruined = np.maximum.accumulate(bankroll < ruin_level * wallet, axis=-1)
+    first_ruin = np.argmax(ruined, axis=-1)
+    ruin_bankroll = np.take_along_axis(bankroll, first_ruin[..., None], axis=-1)
+    return np.where(ruined, ruin_bankroll, bankroll)
+
+def bankroll_risk(df, prob_tensor, wallet, num_paths=10000, markets=tuple(MARKETS), ruin_level=0.1, seed=None, bookmaker='B365', **staking):
+    # Monte Carlo bankroll paths with results drawn from the model's scoreline grids
+    fractions = bet_fractions(df, markets, bookmaker=bookmaker, **staking)
+    home_goals, away_goals = sample_goals(prob_tensor, num_paths, np.random.default_rng(seed))
+    won = outcomes_from_goals(home_goals, away_goals, list(markets))
+    paths = simulate_bankroll(df, fractions, won, wallet, markets, ruin_level, bookmaker)
+    final = paths[:, -1]
+    risk = {
+        'risk_of_ruin': np.mean(paths.min(axis=1) < ruin_level * wallet),
+        'probability_of_profit': np.mean(final > wallet),
+        'median_bankroll': np.median(final),
+        'bankroll_5th_percentile': np.percentile(final, 5),
+        'bankroll_95th_percentile': np.percentile(final, 95)
+    }
+    return paths, risk
+
+def value_scan_summary(df, model_probabilities, margin_method):
+    # Per outcome: how often the best price beats the model, the mean edge then, and who offers it most often
+    rows = []
+    for market, outcomes in [('result', ['H', 'D', 'A']), ('over_under', ['Over2.5', 'Under2.5'])]:
+        scan = scan_value(df, model_probabilities[market], market, margin_method=margin_method)
+        for j, outcome in enumerate(outcomes):
+            value = scan['edge'][:, j] > 0
+            bookmakers, counts = np.unique(scan['best_bookmaker'][value, j], return_counts=True)
+            rows.append({
+                'market': outcome,
+                'value_bets': int(value.sum()),
+                'mean_edge': scan['edge'][value, j].mean() if value.any() else np.nan,
+                'top_bookmaker': bookmakers[np.argmax(counts)] if value.any() else '',
+                'fair_value_bets': int((scan['fair_edge'][:, j] > 0).sum())
+            })
+    return pd.DataFrame(rows).set_index('market')
 
 def main():
     # Set up argument parser
@@ -126,34 +235,59 @@ def main():
 
     parser.add_argument('--match_odds', action='store_true', help='Calculate match odds')
     parser.add_argument('--over_under', action='store_true', help='Set over/under value')
+    parser.add_argument('--ledger', type=str, help='Save every bet placed to this CSV file and show a summary per market')
+    parser.add_argument('--bankroll', action='store_true', help='Simulate the bankroll chronologically with fractional Kelly stakes')
+    parser.add_argument('--kelly_fraction', type=float, default=0.25, help='Fraction of the Kelly stake to bet in the bankroll simulation')
+    parser.add_argument('--max_bet', type=float, default=0.05, help='Largest fraction of the bankroll staked on one bet')
+    parser.add_argument('--max_exposure', type=float, default=0.2, help='Largest fraction of the bankroll staked on one day')
+    parser.add_argument('--paths', type=int, default=10000, help='Number of Monte Carlo bankroll paths for the risk of ruin')
+    parser.add_argument('--bookmaker', type=str, default='B365', help="Bookmaker to bet with, e.g. B365/PS/WH, or 'Best' for the best price across bookmakers")
+    parser.add_argument('--value_scan', type=str, choices=['proportional', 'power', 'shin'],
+                        help='Scan every bookmaker for value, comparing the model with Pinnacle odds de-margined by this method')
+    parser.add_argument('--variant', type=str, help="Backtest a model variant's parameters, e.g. 'xg' for the xG-based model")
     args = parser.parse_args()
 
     # Read data files
-    attacking_scores_csv_path = './data/data_EPL/attacking_scores.csv'
-    defending_scores_csv_path = './data/data_EPL/defending_scores.csv'
-    home_advantage_csv_path = './data/data_EPL/home_advantage.csv'
-    df_attack = pd.read_csv(attacking_scores_csv_path, index_col='team')
-    df_defence = pd.read_csv(defending_scores_csv_path, index_col='team')
-    df_home_advantage = pd.read_csv(home_advantage_csv_path, index_col='parameter')
+    params = load_parameters('EPL', './data', args.variant)
 
-    # Choose league and season
-    df = pd.DataFrame()
-    if args.league == 'EPL' and args.season == "24/25":
-        df = df_epl_24_25('./data/betting_odds/EPL_24_25.csv')
-    elif args.league == 'EPL' and args.season == "23/24":
-        df = df_epl_23_24('./data/betting_odds/EPL_23_24.csv')
-    else: 
-        raise Exception('League and Season not found')
-    df = add_odds_to_df(df, df_attack, df_defence, df_home_advantage)
+    df = load_betting_odds(args.league, args.season, params['teams'])
+    df = add_odds_to_df(df, params)
 
     # Calculate winnings if betting on match odds
     if args.match_odds:
-        winnings = np.round(count_winnings_result(df, args.wallet),2)
+        winnings = np.round(count_winnings_result(df, args.wallet, args.bookmaker),2)
         print(f'Predicted winnings for {args.league} {args.season} season given ${args.wallet}: ${winnings}')
 
     if args.over_under:
-        winnings = np.round(count_winnings_over_under(df, args.wallet),2)
+        winnings = np.round(count_winnings_over_under(df, args.wallet, args.bookmaker),2)
         print(f'Predicted winnings for {args.league} {args.season} season given ${args.wallet} for over/under 2.5 goals: ${winnings}')
+
+    if args.ledger is not None:
+        ledger, summary = backtest(df, args.wallet, bookmaker=args.bookmaker)
+        ledger.to_csv(args.ledger, index=False)
+        print(f'Ledger of {len(ledger)} bets saved as {args.ledger}')
+        print(summary.round(2))
+
+    if args.bankroll:
+        df = add_matchdays(df)
+        staking = {'kelly_fraction': args.kelly_fraction, 'max_bet_fraction': args.max_bet, 'max_exposure': args.max_exposure}
+        fractions = bet_fractions(df, bookmaker=args.bookmaker, **staking)
+        bankroll = simulate_bankroll(df, fractions, market_outcomes(df, list(MARKETS)), args.wallet, bookmaker=args.bookmaker)
+        print(f'Bankroll after {len(bankroll)} matchdays of {args.league} {args.season} season given ${args.wallet}: ${np.round(bankroll[-1],2)}')
+        prob_tensor = price_fixtures(df['HomeTeam'], df['AwayTeam'], params)
+        paths, risk = bankroll_risk(df, prob_tensor, args.wallet, args.paths, bookmaker=args.bookmaker, **staking)
+        print(f'Simulated {args.paths} seasons with results drawn from the model:')
+        for key, value in risk.items():
+            print(f'{key}: {np.round(value, 4)}')
+
+    if args.value_scan is not None:
+        prob_tensor = price_fixtures(df['HomeTeam'], df['AwayTeam'], params)
+        size = prob_tensor.shape[-1]
+        model_probabilities = {
+            'result': market_probabilities(prob_tensor, result_masks(size)),
+            'over_under': market_probabilities(prob_tensor, over_under_masks(size, 2.5))
+        }
+        print(value_scan_summary(df, model_probabilities, args.value_scan).round(3))
     
 
 if __name__ == "__main__":
@@ -0,0 +1,159 @@
+from urllib.parse import urlparse
+import threading
+import re
+import json
+import time
+import os
+
+BASE_URL = 'https://understat.com'
+SNAPSHOT_DIR = os.path.join('data', 'understat')
+
+# Be polite to understat: at most one request per MIN_REQUEST_INTERVAL seconds, from every thread combined
+MIN_REQUEST_INTERVAL = 1.0
+TIMEOUT = 30
+RETRIES = 3
+
+session = None
+session_lock = threading.Lock()
+rate_limit_lock = threading.Lock()
+last_request_time = 0
+
+def get_session():
+    # One pooled session for every request, retrying connection errors and transient server errors
+    global session
+    with session_lock:
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            session = requests.Session()
+            retry = Retry(total=RETRIES, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_maxsize=10, max_retries=retry)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        return session
+
+def wait_for_rate_limit():
+    global last_request_time
+    with rate_limit_lock:
+        wait = last_request_time + MIN_REQUEST_INTERVAL - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        last_request_time = time.monotonic()
+
+def snapshot_path(url, snapshot_dir=SNAPSHOT_DIR):
+    # e.g. https://understat.com/league/EPL/2023 -> data/understat/EPL_2023.json
+    name = '_'.join(urlparse(url).path.strip('/').split('/')[1:])
+    return os.path.join(snapshot_dir, name + '.json')
+
+def read_snapshot(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as file:
+        snapshot = json.load(file)
+    # Snapshots written before teamsData and playersData were kept only hold the matches
+    if 'payloads' not in snapshot:
+        snapshot['payloads'] = {'datesData': snapshot.pop('data')}
+    return snapshot
+
+def write_snapshot(path, snapshot):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(snapshot, file)
+    os.replace(temporary_path, path)
+
+def season_finished(data):
+    # Every fixture has a result, so the page cannot change any more
+    return len(data) > 0 and all(match.get('isResult', False) for match in data)
+
+# Understat embeds each dataset in a script as  var datesData = JSON.parse('...');
+PAYLOAD_START_PATTERN = re.compile(rb"var\s+(\w+)\s*=\s*JSON\.parse\(\s*'")
+JS_ESCAPE_PATTERN = re.compile(r'\\(x[0-9A-Fa-f]{2}|u[0-9A-Fa-f]{4}|.)', re.DOTALL)
+SIMPLE_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f', 'v': '\v', '0': '\0'}
+
+def unescape_js(match):
+    escape = match.group(1)
+    if len(escape) > 1:
+        return chr(int(escape[1:], 16))
+    return SIMPLE_ESCAPES.get(escape, escape)
+
+def decode_js_string(body):
+    # Decode a JavaScript string literal body: the page is UTF-8, and \xNN and \uNNNN are code points
+    # (unicode_escape on its own would re-read UTF-8 bytes as Latin-1 and mangle names such as Atlético)
+    text = body.decode('utf-8')
+    if text.count('\\') == text.count('\\x'):
+        # Only \xNN escapes, which mean the same in Python: escape the non-ASCII characters too, so
+        # that the C unicode_escape codec can decode everything in one pass
+        try:
+            return text.encode('ascii', 'backslashreplace').decode('unicode_escape')
+        except UnicodeDecodeError:
+            pass
+    return JS_ESCAPE_PATTERN.sub(unescape_js, text)
+
+def string_literal_end(content, start):
+    # Index of the quote closing a single-quoted string literal whose body starts at start
+    end = content.find(b"'", start)
+    while end != -1:
+        backslashes = 0
+        while end - backslashes > start and content[end - backslashes - 1] == ord('\\'):
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return end
+        end = content.find(b"'", end + 1)
+    raise ValueError('Unterminated JSON.parse string')
+
+def extract_payloads(content):
+    # Every JSON.parse payload on an understat page by variable name, e.g. datesData, teamsData, playersData.
+    # Scans the raw bytes for the few script statements instead of parsing the whole HTML document.
+    payloads = {}
+    for match in PAYLOAD_START_PATTERN.finditer(content):
+        end = string_literal_end(content, match.end())
+        payloads[match.group(1).decode('ascii')] = json.loads(decode_js_string(content[match.end():end]))
+    return payloads
+
+def parse_league_page(content):
+    # Matches of a league page
+    return extract_payloads(content)['datesData']
+
+def fetch_league_payloads(url, offline=False, snapshot_dir=SNAPSHOT_DIR):
+    # Datasets of a league page (datesData, teamsData and playersData), from its on-disk snapshot when it
+    # cannot have changed. Otherwise a conditional request only downloads the page again if the server
+    # says it changed since the snapshot.
+    path = snapshot_path(url, snapshot_dir)
+    snapshot = read_snapshot(path)
+    if offline:
+        if snapshot is None:
+            raise Exception(f'No snapshot of {url} at {path} to use offline')
+        return snapshot['payloads']
+    if snapshot is not None and season_finished(snapshot['payloads']['datesData']):
+        print(f"Using snapshot of finished season {path}")
+        return snapshot['payloads']
+
+    headers = {}
+    if snapshot is not None and snapshot.get('etag'):
+        headers['If-None-Match'] = snapshot['etag']
+    if snapshot is not None and snapshot.get('last_modified'):
+        headers['If-Modified-Since'] = snapshot['last_modified']
+    wait_for_rate_limit()
+    response = get_session().get(url, headers=headers, timeout=TIMEOUT)
+    if response.status_code == 304:
+        print(f"Unchanged since snapshot {path}")
+        return snapshot['payloads']
+    response.raise_for_status()
+    print("Request Successful")
+
+    payloads = extract_payloads(response.content)
+    if 'datesData' not in payloads:
+        raise Exception(f'No match data found at {url}')
+    write_snapshot(path, {
+        'url': url,
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'payloads': payloads
+    })
+    return payloads
+
+def fetch_league_data(url, offline=False, snapshot_dir=SNAPSHOT_DIR):
+    # Matches of a league page
+    return fetch_league_payloads(url, offline, snapshot_dir)['datesData']